@@ -0,0 +1,92 @@
+# Compression of a guide file at each gzip level and thread count, to pick
+# PLUTO_GZIP_LEVEL and PLUTO_GZIP_THREADS.
+#
+#   python benchmarks/bench_gzip.py [epg.xml | channels]
+#
+# Without a file, an epg-all for the given number of synthetic channels per
+# country (default 400) is rendered first. Every output is decompressed again
+# and checked against the input.
+#
+# Compression runs in a spawned worker, as render_guide does in the server.
+# Its OS thread count shows whether the gzip threads really ran as threads.
+import gzip, io, multiprocessing, os, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import pluto
+from fake_pluto import SyntheticPluto
+from xmltv import ParallelGzipFile
+
+COUNTRIES = ['local', 'us_east', 'us_west', 'ca', 'uk', 'fr', 'de']
+LEVELS = (1, 6, 9)
+THREADS = (1, 2, 4, 8)
+CHUNK = 64 * 1024
+
+
+def synthetic_guide(channels, hours=36):
+    source = SyntheticPluto(channels)
+    client = pluto.Client()
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    for country in COUNTRIES:
+        lineup = source.lineup(country)
+        client.all_channels[country] = client.build_stations(country, lineup, source.categories(country))
+        ids = [channel['id'] for channel in lineup]
+        store = pluto.TimelineStore()
+        for w in range(hours // 12):
+            window = start + timedelta(hours=12 * w)
+            for i in range(0, len(ids), 100):
+                store.add(window, pluto.ingest_page(source.timelines(ids[i:i + 100], window, 720)))
+        client.epg_data[country] = store.pages(ids)
+
+    stations, _ = client.channels_all()
+    pages = client.get_all_epg_data(COUNTRIES, fetch=False)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'epg-all.xml')
+        pluto.render_guide(path, f"{path}.gz", stations, pages, client.genre_map, 1, 1, 1)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def compress(data, level, threads):
+    # Runs in the worker, returns the ratio, the seconds taken and the OS threads seen
+    out = io.BytesIO()
+    if threads > 1:
+        writer = ParallelGzipFile(out, 'epg-all.xml', level, threads)
+    else:
+        writer = gzip.GzipFile(filename='epg-all.xml', mode='wb', fileobj=out, compresslevel=level)
+    started = time.perf_counter()
+    for i in range(0, len(data), CHUNK):
+        writer.write(data[i:i + CHUNK])
+    os_threads = len(os.listdir('/proc/self/task'))
+    writer.close()
+    elapsed = time.perf_counter() - started
+    compressed = out.getvalue()
+    if gzip.decompress(compressed) != data:
+        raise ValueError(f"level {level} threads {threads}: output does not decompress to the input")
+    return len(data) / len(compressed), elapsed, os_threads
+
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else '400'
+    if os.path.exists(arg):
+        with open(arg, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_guide(int(arg))
+
+    print(f"{len(data) / 2**20:.1f} MiB of XML, {os.cpu_count()} CPUs")
+    print(f"  level  threads    ratio      MiB/s    seconds  os threads")
+    worker = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+    for level in LEVELS:
+        for threads in THREADS:
+            ratio, elapsed, os_threads = worker.submit(compress, data, level, threads).result()
+            print(f"  {level:5d}  {threads:7d}  {ratio:7.2f}  {len(data) / 2**20 / elapsed:9.1f}  {elapsed:9.3f}"
+                  f"  {os_threads:10d}")
+    worker.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# Memory held by a refresh's guide data: raw timeline JSON against the
+# Programme records epg_data keeps now.
+#
+#   python benchmarks/bench_memory.py [channels] [countries] [hours]
+#
+# Pages are serialised and parsed again so every string is its own object,
+# the way response.json() hands them over.
+import gc, json, os, sys, tracemalloc
+from datetime import datetime, timedelta, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import pluto
+from fake_pluto import SyntheticPluto
+
+COUNTRIES = ['local', 'us_east', 'us_west', 'ca', 'uk', 'fr', 'de']
+
+
+def responses(source, countries, hours):
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    for country in countries:
+        ids = [channel['id'] for channel in source.lineup(country)]
+        for w in range(max(1, hours // 12)):
+            window = start + timedelta(hours=12 * w)
+            for i in range(0, len(ids), 100):
+                yield country, window, json.dumps(source.timelines(ids[i:i + 100], window, 720))
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    data = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return data, size
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    countries = COUNTRIES[:int(sys.argv[2]) if len(sys.argv) > 2 else len(COUNTRIES)]
+    hours = int(sys.argv[3]) if len(sys.argv) > 3 else 36
+    bodies = list(responses(SyntheticPluto(channels), countries, hours))
+
+    def raw():
+        return [json.loads(body) for _, _, body in bodies]
+
+    def compact():
+        stores = {}
+        for country, window, body in bodies:
+            stores.setdefault(country, pluto.TimelineStore()).add(window, pluto.ingest_page(json.loads(body)))
+        return stores
+
+    raw_pages, raw_size = measure(raw)
+    programmes = sum(len(entry['timelines']) for page in raw_pages for entry in page['data'])
+    del raw_pages
+    _, compact_size = measure(compact)
+
+    print(f"{programmes} programmes ({channels} channels x {len(countries)} countries x {hours} hours)")
+    print(f"  raw timeline JSON   {raw_size / 2**20:8.1f} MiB  {raw_size / programmes:8.0f} bytes/programme")
+    print(f"  Programme records   {compact_size / 2**20:8.1f} MiB  {compact_size / programmes:8.0f} bytes/programme"
+          f"  {raw_size / compact_size:5.1f}x smaller")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Benchmark of the cross-country merge behind epg-all (Client.get_all_epg_data).
+#
+#   python benchmarks/bench_merge.py [channels] [hours]
+#
+# Feeds the client synthetic lineups and guide pages for 1..7 countries and
+# times the merge, which should grow linearly with the number of countries.
+import os, sys, time
+from datetime import datetime, timedelta, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import pluto
+from fake_pluto import SyntheticPluto
+
+COUNTRIES = ['local', 'us_east', 'us_west', 'ca', 'uk', 'fr', 'de']
+
+
+def load(client, source, countries, hours):
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    for country in countries:
+        lineup = source.lineup(country)
+        client.all_channels[country] = client.build_stations(country, lineup, source.categories(country))
+        ids = [channel['id'] for channel in lineup]
+        store = pluto.TimelineStore()
+        for w in range(max(1, hours // 12)):
+            window = start + timedelta(hours=12 * w)
+            for i in range(0, len(ids), 100):
+                store.add(window, pluto.ingest_page(source.timelines(ids[i:i + 100], window, 720)))
+        client.epg_data[country] = store.pages(ids)
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    hours = int(sys.argv[2]) if len(sys.argv) > 2 else 36
+    source = SyntheticPluto(channels)
+    client = pluto.Client()
+    load(client, source, COUNTRIES, hours)
+    lineups = dict(client.all_channels)
+    print(f"{channels} channels per country, {hours} hours")
+
+    for n in range(1, len(COUNTRIES) + 1):
+        countries = COUNTRIES[:n]
+        client.all_channels = {country: lineups[country] for country in countries}
+        best = None
+        for _ in range(3):
+            started = time.perf_counter()
+            pages = client.get_all_epg_data(countries, fetch=False)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        programmes = sum(len(entry['timelines']) for page in pages for entry in page['data'])
+        print(f"  {n} countries  {best * 1000:8.1f} ms  {programmes:8d} programmes  {best / n * 1000:6.1f} ms/country")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Text sanitising: the per-render regex and per-character unicodedata scans
+# against the translate tables applied once at ingestion (sanitize.py).
+#
+#   python benchmarks/bench_sanitize.py [channels]
+import os, re, sys, time, unicodedata
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import sanitize
+from fake_pluto import SyntheticPluto
+
+
+def strip_illegal_characters(xml_string):
+    illegal_char_pattern = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+    return illegal_char_pattern.sub('', xml_string)
+
+
+def remove_non_printable(s):
+    return ''.join([char for char in s if not unicodedata.category(char).startswith('C')])
+
+
+def best(func, repeat=5):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    source = SyntheticPluto(channels)
+    window = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    ids = [channel['id'] for channel in source.lineup('local')]
+    timelines = [timeline for i in range(0, len(ids), 100)
+                 for entry in source.timelines(ids[i:i + 100], window, 720)['data'] for timeline in entry['timelines']]
+    texts = [(t['title'], t['episode']['name'], t['episode']['description']) for t in timelines]
+    summaries = [channel.get('summary') or '' for channel in source.lineup('local')]
+
+    def old_guide():
+        for title, name, description in texts:
+            strip_illegal_characters(title)
+            strip_illegal_characters(name)
+            strip_illegal_characters(description).replace('&quot;', '"')
+
+    def new_guide():
+        sanitize.description.cache_clear()
+        for title, name, description in texts:
+            sanitize.xml_text(title)
+            sanitize.xml_text(name)
+            sanitize.description(description)
+
+    print(f"{len(texts)} programmes, {len(summaries)} channel summaries")
+    old, new = best(old_guide), best(new_guide)
+    print(f"  programme text   regex {old * 1000:8.1f} ms   translate {new * 1000:8.1f} ms   {old / new:5.1f}x")
+    old = best(lambda: [remove_non_printable(s) for s in summaries])
+    new = best(lambda: [sanitize.printable(s) for s in summaries])
+    print(f"  summaries        scan  {old * 1000:8.1f} ms   translate {new * 1000:8.1f} ms   {old / new:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Micro-benchmark of the Pluto -> XMLTV timestamp conversions used by programme_element.
+#
+#   python benchmarks/bench_timestamps.py [channels] [hours]
+#
+# Compares the previous per-programme strptime/strftime path with the
+# cached fixed-format converters in xmltv.py.
+import os, sys, time, random
+from datetime import datetime, timedelta
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from xmltv import xmltv_time, xmltv_air_date, xmltv_date
+
+PLUTO_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def synthetic_programmes(channels, hours):
+    # Programmes start on 30 or 60 minute boundaries, so start/stop values
+    # repeat across channels just like a real guide
+    start = datetime.now(pytz.utc).replace(minute=0, second=0, microsecond=0)
+    rnd = random.Random(0)
+    programmes = []
+    for _ in range(channels):
+        t = start
+        while t < start + timedelta(hours=hours):
+            stop = t + timedelta(minutes=rnd.choice((30, 60)))
+            release = datetime(rnd.randint(1970, 2024), rnd.randint(1, 12), rnd.randint(1, 28))
+            programmes.append((t.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                               stop.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                               release.strftime("%Y-%m-%dT%H:%M:%S.000Z")))
+            t = stop
+    return programmes
+
+
+def strptime_path(programmes):
+    for start, stop, released in programmes:
+        datetime.strptime(start, PLUTO_FORMAT).replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")
+        datetime.strptime(stop, PLUTO_FORMAT).replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")
+        datetime.strptime(released, PLUTO_FORMAT).replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+        datetime.strptime(released, PLUTO_FORMAT).strftime("%Y%m%d")
+
+
+def converter_path(programmes):
+    for start, stop, released in programmes:
+        xmltv_time(start)
+        xmltv_time(stop)
+        xmltv_air_date(released)
+        xmltv_date(released)
+
+
+def clear_caches():
+    xmltv_time.cache_clear()
+    xmltv_air_date.cache_clear()
+    xmltv_date.cache_clear()
+
+
+def timed(func, programmes, repeat=3, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup: setup()
+        t0 = time.perf_counter()
+        func(programmes)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    hours = int(sys.argv[2]) if len(sys.argv) > 2 else 36
+    programmes = synthetic_programmes(channels, hours)
+    print(f"{len(programmes)} programmes ({channels} channels x {hours} hours), 4 conversions each")
+
+    results = [("strptime", timed(strptime_path, programmes)),
+               ("converter (cold cache)", timed(converter_path, programmes, setup=clear_caches)),
+               ("converter (warm cache)", timed(converter_path, programmes))]
+
+    baseline = results[0][1]
+    for name, elapsed in results:
+        rate = len(programmes) / elapsed
+        print(f"  {name:<24} {elapsed * 1000:9.1f} ms  {rate:12,.0f} programmes/s  {baseline / elapsed:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Redirect throughput of the /<provider>/<country_code>/watch/<id> route.
+#
+#   python benchmarks/bench_watch.py [requests] [channels]
+#
+# Runs through Flask's test client, so it measures the route and WSGI stack
+# without network noise. The previous urlparse/parse_qs/urlencode handler is
+# registered next to the current one as a reference.
+import contextlib, io, os, sys, time, uuid
+from urllib.parse import urlparse, urlencode, urlunparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("PLUTO_CACHE_PATH", "")
+import pywsgi
+from flask import redirect
+
+
+def legacy_watch(provider, country_code, id):
+    client_id = pywsgi.providers[provider].load_device()
+    sid = uuid.uuid4()
+    jwt_required_list = ['625f054c5dfea70007244612', '625f04253e5f6c000708f3b7', '5421f71da6af422839419cb3']
+    if id in jwt_required_list:
+        return "JWT channels are not part of this benchmark", 400
+
+    video_url = legacy_url(id, client_id, sid)
+    print(video_url)
+    return redirect(video_url)
+
+
+def legacy_url(id, client_id, sid):
+    stitcher = "https://cfd-v4-service-channel-stitcher-use1-1.prd.pluto.tv"
+    base_path = f"/stitch/hls/channel/{id}/master.m3u8"
+
+    params = {'advertisingId': '', 'appName': 'web', 'appVersion': 'unknown', 'appStoreUrl': '',
+              'architecture': '', 'buildVersion': '', 'clientTime': '0', 'deviceDNT': '0',
+              'deviceId': client_id, 'deviceMake': 'Chrome', 'deviceModel': 'web', 'deviceType': 'web',
+              'deviceVersion': 'unknown', 'includeExtendedEvents': 'false', 'sid': sid, 'userId': '',
+              'serverSideAds': 'true'}
+
+    parsed_url = urlparse(f"{stitcher}{base_path}")
+    base_query_params = parse_qs(parsed_url.query)
+    for key, value in params.items():
+        if key in base_query_params:
+            base_query_params[key].extend(value)
+        else:
+            base_query_params[key] = value
+    updated_query = urlencode(base_query_params, doseq=True)
+    return urlunparse((parsed_url.scheme, parsed_url.netloc, parsed_url.path,
+                       parsed_url.params, updated_query, parsed_url.fragment))
+
+
+pywsgi.app.add_url_rule("/legacy/<provider>/<country_code>/watch/<id>", "legacy_watch", legacy_watch)
+
+
+def run(client, prefix, channel_ids, count):
+    # Printing is part of the legacy cost, but keep it off the terminal
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        for i in range(count):
+            response = client.get(f"{prefix}/pluto/us_east/watch/{channel_ids[i % len(channel_ids)]}")
+            assert response.status_code == 302
+        return time.perf_counter() - t0
+
+
+def url_only(channel_ids, count):
+    # URL construction alone, without Flask and the test client around it
+    client_id = pywsgi.providers['pluto'].load_device()
+    t0 = time.perf_counter()
+    for i in range(count):
+        legacy_url(channel_ids[i % len(channel_ids)], client_id, uuid.uuid4())
+    legacy = time.perf_counter() - t0
+
+    templates = {}
+    t0 = time.perf_counter()
+    for i in range(count):
+        id = channel_ids[i % len(channel_ids)]
+        template = templates.get(id)
+        if template is None:
+            template = templates[id] = pywsgi.stitcher_template(id, client_id)
+        f"{template[0]}{uuid.uuid4()}{template[1]}"
+    return legacy, time.perf_counter() - t0
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    channels = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    channel_ids = [f"{i:024x}" for i in range(channels)]
+    client = pywsgi.app.test_client()
+
+    # Warm both paths, including the per-channel template cache
+    run(client, "", channel_ids, channels)
+    run(client, "/legacy", channel_ids, channels)
+
+    print(f"{count} redirects across {channels} channels")
+    legacy = run(client, "/legacy", channel_ids, count)
+    current = run(client, "", channel_ids, count)
+    print(f"  legacy   {count / legacy:10,.0f} req/s  {legacy / count * 1e6:8.1f} us/req")
+    print(f"  current  {count / current:10,.0f} req/s  {current / count * 1e6:8.1f} us/req  {legacy / current:5.2f}x")
+
+    legacy, current = url_only(channel_ids, count)
+    print("stitcher URL construction only")
+    print(f"  legacy   {count / legacy:10,.0f} urls/s  {legacy / count * 1e6:8.1f} us/url")
+    print(f"  current  {count / current:10,.0f} urls/s  {current / count * 1e6:8.1f} us/url  {legacy / current:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+# Local stand-in for the Pluto endpoints the client talks to, used by the
+# offline benchmarks.
+#
+#   python benchmarks/fake_pluto.py serve --port 7778 --channels 400
+#   python benchmarks/fake_pluto.py serve --port 7778 --fixtures recorded/
+#   python benchmarks/fake_pluto.py record recorded/ --country us_east
+#
+# "serve" answers /v4/start, /v2/guide/channels, /v2/guide/categories and
+# /v2/guide/timelines with synthetic data, or replays a recorded fixture
+# directory. Programme boundaries are a pure function of channel and time, so
+# overlapping windows agree with each other just like the real service.
+# The stitcher's master.m3u8 is served too, after --stitcher-delay seconds.
+# GET /_stats returns request counts per endpoint, POST /_stats/reset clears them.
+import argparse, glob, json, os, sys, zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flask import Flask, request, jsonify
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+BLOCK = timedelta(hours=2)
+# Ways of splitting a two hour block into programmes, in minutes
+BLOCK_PATTERNS = ((30, 30, 60), (60, 60), (120,), (30, 90), (90, 30), (30, 30, 30, 30))
+GENRES = ("Family Animation", "News and Information", "Crime Drama", "Classic Comedies", "Reality",
+          "Documentaries", "Sports", "Action & Adventure", "Westerns", "Cooking Instruction", "Kids",
+          "Talk Show", "Game Show", "Thrillers", "Anime", "Music")
+CATEGORIES = ("Movies", "News", "Comedy", "Crime", "Reality", "Kids", "Sports", "Classic TV",
+              "Food", "Music", "Explore", "Latino")
+SERIES_TYPES = ("tv", "tv", "tv", "film", "live")
+COUNTRY_BY_IP = {"178.238.11.6": "uk", "192.206.151.131": "ca", "193.169.64.141": "fr",
+                 "81.173.176.155": "de", "108.82.206.181": "us_east", "76.81.9.69": "us_west"}
+US_COUNTRIES = ("local", "us_east", "us_west")
+
+
+def crc(*parts):
+    return zlib.crc32('|'.join(map(str, parts)).encode())
+
+
+class SyntheticPluto:
+    def __init__(self, channels=400, overlap=0.5, seed=0):
+        self.channels = channels
+        self.overlap = overlap
+        self.seed = seed
+        self._lineups = {}
+
+    def lineup(self, country):
+        # US regions share one lineup, other countries share the first
+        # `overlap` fraction of it and carry their own channels after that
+        region = 'us' if country in US_COUNTRIES else country
+        if region not in self._lineups:
+            shared = self.channels if region == 'us' else int(self.channels * self.overlap)
+            lineup = []
+            for i in range(self.channels):
+                owner = 'us' if i < shared else region
+                channel_id = f"{crc(owner, i, self.seed):08x}{i:016x}"
+                # Every tenth channel reuses its neighbour's number to exercise renumbering
+                number = 100 + i - (1 if i % 10 == 9 else 0)
+                lineup.append({
+                    'id': channel_id,
+                    'name': f"Channel {owner.upper()} {i}",
+                    'slug': f"channel-{owner}-{i}",
+                    'tmsid': str(crc(channel_id))[:6] if i % 3 == 0 else None,
+                    'summary': f"Round-the-clock programming for channel {i}.\u200b Always free.",
+                    'number': number,
+                    'hash': f"#{channel_id[:8]}",
+                    'isStitched': True,
+                    'onDemand': False,
+                    'featured': i % 25 == 0,
+                    'images': [{'type': kind, 'url': f"https://images.example.invalid/{channel_id}/{kind}.png",
+                                'style': 'default', 'ratio': 1.0, 'defaultWidth': 400, 'defaultHeight': 400}
+                               for kind in ('colorLogoSVG', 'colorLogoPNG', 'darkLogoPNG', 'solidLogoPNG', 'featuredImage')],
+                })
+            self._lineups[region] = lineup
+        return self._lineups[region]
+
+    def categories(self, country):
+        categories = {name: [] for name in CATEGORIES}
+        for i, channel in enumerate(self.lineup(country)):
+            categories[CATEGORIES[i % len(CATEGORIES)]].append(channel['id'])
+        return [{'id': f"{crc(name):08x}", 'name': name, 'channelIDs': ids} for name, ids in categories.items()]
+
+    def programme(self, channel_id, start, stop, index):
+        rnd = crc(channel_id, start.isoformat())
+        series_type = SERIES_TYPES[rnd % len(SERIES_TYPES)]
+        series = rnd % 97
+        release = start if series_type == 'live' and rnd % 2 else datetime(1970 + rnd % 54, 1 + rnd % 12, 1 + rnd % 28)
+        return {
+            '_id': f"{rnd:08x}{index:08x}",
+            'start': start.strftime(TIME_FORMAT),
+            'stop': stop.strftime(TIME_FORMAT),
+            'title': f"Series {series} & Friends",
+            'episode': {
+                '_id': f"{crc(channel_id, series, index):08x}",
+                'number': 1 + rnd % 24,
+                'season': 1 + rnd % 9,
+                'name': f"Episode {rnd % 1000}" if rnd % 3 else f"Series {series} & Friends",
+                'description': f"An episode of series {series} where &quot;everything\u0007 changes&quot;. " * (1 + rnd % 3),
+                'genre': GENRES[rnd % len(GENRES)],
+                'subGenre': GENRES[(rnd >> 4) % len(GENRES)] if rnd % 4 else None,
+                'duration': int((stop - start).total_seconds() * 1000),
+                'rating': 'TV-14',
+                'clip': {'originalReleaseDate': release.strftime(TIME_FORMAT)},
+                'series': {'_id': f"{crc('series', series):08x}", 'name': f"Series {series}", 'type': series_type,
+                           'tile': {'path': f"https://images.example.invalid/series/{series}/tile.jpg"},
+                           'featuredImage': {'path': f"https://images.example.invalid/series/{series}/featured.jpg"}},
+                'poster': {'path': f"https://images.example.invalid/series/{series}/poster.jpg"},
+                'thumbnail': {'path': f"https://images.example.invalid/series/{series}/thumb.jpg"},
+            },
+        }
+
+    def timelines(self, channel_ids, start, duration):
+        end = start + timedelta(minutes=duration)
+        epoch = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        data = []
+        for channel_id in channel_ids:
+            block = epoch + ((start - epoch) // BLOCK) * BLOCK
+            timelines = []
+            while block < end:
+                t = block
+                for minutes in BLOCK_PATTERNS[crc(channel_id, block.isoformat()) % len(BLOCK_PATTERNS)]:
+                    stop = t + timedelta(minutes=minutes)
+                    if stop > start and t < end:
+                        timelines.append(self.programme(channel_id, t, stop, len(timelines)))
+                    t = stop
+                block += BLOCK
+            data.append({'channelId': channel_id, 'timelines': timelines})
+        return {'meta': {'startDateTime': start.strftime(TIME_FORMAT), 'endDateTime': end.strftime(TIME_FORMAT)},
+                'data': data}
+
+
+class RecordedPluto:
+    # Replays a directory written by the "record" command. Programme times are
+    # shifted so the recording starts at the current hour.
+    def __init__(self, path):
+        with open(os.path.join(path, 'channels.json'), encoding='utf-8') as f:
+            self.channel_list = json.load(f)
+        with open(os.path.join(path, 'categories.json'), encoding='utf-8') as f:
+            self.category_list = json.load(f)
+        self.programmes = {}
+        for page_path in sorted(glob.glob(os.path.join(path, 'timelines', '*.json'))):
+            with open(page_path, encoding='utf-8') as f:
+                for entry in json.load(f).get('data', []):
+                    programmes = self.programmes.setdefault(entry['channelId'], {})
+                    for timeline in entry['timelines']:
+                        programmes[timeline['start']] = timeline
+        starts = [start for programmes in self.programmes.values() for start in programmes]
+        first = datetime.strptime(min(starts), "%Y-%m-%dT%H:%M:%S.%fZ") if starts else datetime.utcnow()
+        now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        self.shift = now - first.replace(minute=0, second=0, microsecond=0)
+
+    def lineup(self, country):
+        return self.channel_list
+
+    def categories(self, country):
+        return self.category_list
+
+    def shifted(self, value):
+        return (datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ") + self.shift).strftime(TIME_FORMAT)
+
+    def timelines(self, channel_ids, start, duration):
+        start = start.replace(tzinfo=None)
+        end = start + timedelta(minutes=duration)
+        data = []
+        for channel_id in channel_ids:
+            timelines = []
+            for timeline in self.programmes.get(channel_id, {}).values():
+                timeline = dict(timeline, start=self.shifted(timeline['start']), stop=self.shifted(timeline['stop']))
+                if timeline['stop'] > start.strftime(TIME_FORMAT) and timeline['start'] < end.strftime(TIME_FORMAT):
+                    timelines.append(timeline)
+            data.append({'channelId': channel_id, 'timelines': sorted(timelines, key=lambda t: t['start'])})
+        return {'meta': {'startDateTime': start.strftime(TIME_FORMAT), 'endDateTime': end.strftime(TIME_FORMAT)},
+                'data': data}
+
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="English",LANGUAGE="en",URI="subs/en.m3u8"
+#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=800000,RESOLUTION=640x360,SUBTITLES="subs"
+0/playlist.m3u8?sid={sid}
+#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=2000000,RESOLUTION=1280x720,SUBTITLES="subs"
+1/playlist.m3u8?sid={sid}
+#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=4500000,RESOLUTION=1920x1080,SUBTITLES="subs"
+2/playlist.m3u8?sid={sid}
+"""
+
+
+def create_app(source, stitcher_delay=0.0):
+    app = Flask(__name__)
+    stats = Counter()
+
+    def country():
+        return COUNTRY_BY_IP.get(request.headers.get('X-Forwarded-For', ''), 'local')
+
+    @app.get("/v4/start")
+    def start():
+        stats['boot'] += 1
+        return jsonify({'sessionToken': f"token-{country()}-{stats['boot']}",
+                        'stitcherParams': 'deviceType=web&deviceMake=chrome',
+                        'session': {'sessionID': f"session-{stats['boot']}"}})
+
+    @app.get("/v2/guide/channels")
+    def channels():
+        stats['channels'] += 1
+        return jsonify({'data': source.lineup(country())})
+
+    @app.get("/v2/guide/categories")
+    def categories():
+        stats['categories'] += 1
+        return jsonify({'data': source.categories(country())})
+
+    @app.get("/v2/guide/timelines")
+    def timelines():
+        stats['timelines'] += 1
+        start = datetime.strptime(request.args['start'], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+        channel_ids = [i for i in request.args.get('channelIds', '').split(',') if i]
+        return jsonify(source.timelines(channel_ids, start, int(request.args.get('duration', 720))))
+
+    @app.get("/stitch/hls/channel/<id>/master.m3u8")
+    @app.get("/v2/stitch/hls/channel/<id>/master.m3u8")
+    def master(id):
+        stats['stitcher'] += 1
+        if stitcher_delay:
+            import gevent
+            gevent.sleep(stitcher_delay)
+        return MASTER_PLAYLIST.format(sid=request.args.get('sid', '')), 200, {'Content-Type': 'application/vnd.apple.mpegurl'}
+
+    @app.get("/_stats")
+    def get_stats():
+        return jsonify(dict(stats))
+
+    @app.post("/_stats/reset")
+    def reset_stats():
+        stats.clear()
+        return jsonify({})
+
+    return app
+
+
+def record(path, country, range_count):
+    # Fetch the real service once through the client and keep every JSON response
+    import pluto
+    client = pluto.Client()
+    os.makedirs(os.path.join(path, 'timelines'), exist_ok=True)
+    pages = []
+
+    def save(response, *args, **kwargs):
+        name = response.request.path_url.split('?')[0].rsplit('/', 1)[-1]
+        if name == 'timelines':
+            pages.append(response.json())
+        elif name in ('channels', 'categories'):
+            with open(os.path.join(path, f"{name}.json"), 'w', encoding='utf-8') as f:
+                json.dump(response.json().get('data'), f)
+
+    client.session.hooks['response'].append(save)
+    error = client.update_epg(country, range_count)
+    if error:
+        sys.exit(f"Recording failed: {error}")
+    for i, page in enumerate(pages):
+        with open(os.path.join(path, 'timelines', f"{i:04d}.json"), 'w', encoding='utf-8') as f:
+            json.dump(page, f)
+    print(f"Recorded {len(pages)} timeline pages for {country} into {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=7778)
+    serve.add_argument('--channels', type=int, default=400)
+    serve.add_argument('--overlap', type=float, default=0.5)
+    serve.add_argument('--seed', type=int, default=0)
+    serve.add_argument('--fixtures')
+    serve.add_argument('--stitcher-delay', type=float, default=0.05)
+    rec = commands.add_parser('record')
+    rec.add_argument('path')
+    rec.add_argument('--country', default='us_east')
+    rec.add_argument('--range-count', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.path, args.country, args.range_count)
+        return
+
+    from gevent.pywsgi import WSGIServer
+    source = RecordedPluto(args.fixtures) if args.fixtures else SyntheticPluto(args.channels, args.overlap, args.seed)
+    print(f"fake pluto listening on {args.host}:{args.port}", flush=True)
+    WSGIServer((args.host, args.port), create_app(source, args.stitcher_delay), log=None).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+# End-to-end benchmark of the EPG and playlist pipeline against the local
+# stand-in in fake_pluto.py, so results do not depend on the real service.
+#
+#   python benchmarks/run.py [--channels 400] [--countries local,ca,uk] [--hours 36]
+#   python benchmarks/run.py --fixtures recorded/ --countries us_east
+#   python benchmarks/run.py --json baseline.json
+#   python benchmarks/run.py --compare baseline.json [--tolerance 0.25]
+#
+# Every phase reports wall time, peak RSS and the number of upstream requests
+# it made. --compare exits non-zero when a phase is slower, uses more memory or
+# makes more requests than the saved baseline by more than the tolerance.
+import argparse, json, math, os, socket, subprocess, sys, tempfile, time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, REPO_DIR)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake(args, port):
+    command = [sys.executable, os.path.join(BENCH_DIR, 'fake_pluto.py'), 'serve', '--port', str(port),
+               '--channels', str(args.channels), '--overlap', str(args.overlap)]
+    if args.fixtures:
+        command += ['--fixtures', os.path.abspath(args.fixtures)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            fake_stats(port)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit("fake pluto did not start")
+
+
+def fake_stats(port, reset=False):
+    url = f"http://127.0.0.1:{port}/_stats" + ("/reset" if reset else "")
+    with urllib.request.urlopen(urllib.request.Request(url, method='POST' if reset else 'GET'), timeout=5) as response:
+        return json.load(response)
+
+
+def peak_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    # Linux resets VmHWM to the current RSS when "5" is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class Phases:
+    def __init__(self, port):
+        self.port = port
+        self.results = {}
+
+    def measure(self, name, func, operations=None):
+        fake_stats(self.port, reset=True)
+        rss_reset = reset_peak_rss()
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        result = {'seconds': round(elapsed, 4),
+                  'peak_rss_kb': peak_rss_kb(),
+                  'peak_rss_reset': rss_reset,
+                  'requests': sum(fake_stats(self.port).values())}
+        if operations:
+            result['per_second'] = round(operations / elapsed, 1)
+        self.results[name] = result
+        rate = f"{result['per_second']:>12,.0f}/s" if operations else ''
+        print(f"  {name:<28} {elapsed * 1000:10.1f} ms  {result['peak_rss_kb'] / 1024:8.1f} MiB  "
+              f"{result['requests']:6d} req{rate}", flush=True)
+
+
+def run(args):
+    port = free_port()
+    fake = start_fake(args, port)
+    workdir = tempfile.mkdtemp(prefix='pluto-bench-')
+    countries = args.countries.split(',')
+    range_count = max(1, math.ceil(args.hours / 12))
+
+    os.environ['PLUTO_CODE'] = args.countries
+    os.environ['PLUTO_CACHE_PATH'] = ''
+    os.environ['PLUTO_EPG_CONCURRENCY'] = str(args.concurrency)
+    os.environ['PLUTO_RENDER_WORKERS'] = str(args.render_workers)
+    os.environ['PLUTO_GZIP_LEVEL'] = str(args.gzip_level)
+    os.environ['PLUTO_GZIP_THREADS'] = str(args.gzip_threads)
+    os.environ['PLUTO_EPG_FRAGMENT_CACHE'] = 'false' if args.no_fragment_cache else 'true'
+    os.chdir(workdir)
+    try:
+        import pywsgi, pluto
+        from xmltv import XMLTVWriter
+        client = pywsgi.providers['pluto']
+        client.boot_url = client.service_url = f"http://127.0.0.1:{port}"
+        http = pywsgi.app.test_client()
+        phases = Phases(port)
+        print(f"{args.channels} channels, {','.join(countries)}, {range_count} x 12h windows, "
+              f"concurrency {args.concurrency}, output in {workdir}")
+
+        def lineups():
+            for country in countries:
+                _, error = client.channels(country)
+                if error: sys.exit(f"channels({country}): {error}")
+
+        def update_epg():
+            for country in countries:
+                error = client.update_epg(country, range_count)
+                if error: sys.exit(f"update_epg({country}): {error}")
+
+        def programme_elements():
+            # The per-programme build and serialisation render_guide does, without the channels
+            with XMLTVWriter('programme-elements.xml', 'programme-elements.xml.gz') as writer:
+                for country in countries:
+                    for page in client.epg_data[country]:
+                        for entry in page['data']:
+                            for timeline in entry['timelines']:
+                                writer.write(pluto.programme_element(entry['channelId'], timeline, client.genre_map))
+            phases.programmes = writer.element_count
+
+        def create_xml_files():
+            for country in countries:
+                error = client.create_xml_file(country, fetch=False)
+                if error: sys.exit(f"create_xml_file({country}): {error}")
+
+        def create_xml_all():
+            error = client.create_xml_file(countries, fetch=False)
+            if error: sys.exit(f"create_xml_file(all): {error}")
+
+        def create_xml_steady():
+            # Every file again from unchanged guide data, as a refresh where
+            # nothing moved; with the fragment cache only I/O and gzip are left
+            create_xml_files()
+            create_xml_all()
+
+        def channels_all():
+            _, error = client.channels_all()
+            if error: sys.exit(f"channels_all: {error}")
+
+        def playlist_render():
+            pywsgi.playlists['pluto'].rebuild()
+
+        def get(path, count):
+            for _ in range(count):
+                response = http.get(path)
+                if response.status_code >= 400:
+                    sys.exit(f"GET {path}: {response.status_code}")
+
+        def watch_during_render():
+            # /watch latency while epg-all renders, flat when rendering is off the hub
+            import gevent
+            latencies = []
+            rendering = [True]
+            channel_id = client.all_channels[countries[0]][0]['id']
+
+            def probe():
+                while rendering[0]:
+                    # Measured from when the request was due, a blocked hub delays it
+                    due = time.perf_counter() + 0.005
+                    gevent.sleep(0.005)
+                    http.get(f"/pluto/{countries[0]}/watch/{channel_id}")
+                    latencies.append(time.perf_counter() - due)
+
+            prober = gevent.spawn(probe)
+            gevent.sleep(0.05)
+            error = client.create_xml_file(countries, fetch=False)
+            rendering[0] = False
+            prober.join()
+            if error: sys.exit(f"create_xml_file(all): {error}")
+            latencies.sort()
+            phases.watch_latency = {'requests': len(latencies),
+                                    'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+                                    'p99_ms': round(latencies[len(latencies) * 99 // 100] * 1000, 2),
+                                    'max_ms': round(latencies[-1] * 1000, 2)}
+            print(f"    /watch during render: {phases.watch_latency}")
+
+        def watch_proxied():
+            # Tunes served from the master playlist cache, 20 viewers per channel
+            # tuning at once should cost one stitcher request per channel
+            import gevent
+            pywsgi.stitcher_proxy = True
+            pywsgi.STITCHER = f"http://127.0.0.1:{port}"
+            pywsgi.stitcher_templates.clear()
+            channel_ids = [station['id'] for station in client.all_channels[countries[0]]][:args.requests // 20]
+
+            def tune(channel_id):
+                response = http.get(f"/pluto/{countries[0]}/watch/{channel_id}")
+                if response.status_code != 200 or b'#EXTM3U' not in response.data:
+                    sys.exit(f"proxied watch: {response.status_code}")
+
+            gevent.joinall([gevent.spawn(tune, channel_id) for channel_id in channel_ids for _ in range(20)])
+            pywsgi.stitcher_proxy = False
+
+        def watch():
+            channel_ids = [station['id'] for station in client.all_channels[countries[0]]]
+            for i in range(args.requests):
+                response = http.get(f"/pluto/{countries[0]}/watch/{channel_ids[i % len(channel_ids)]}")
+                if response.status_code != 302:
+                    sys.exit(f"watch: {response.status_code}")
+
+        phases.measure('channels', lineups)
+        phases.measure('update_epg', update_epg)
+        phases.measure('programme_element', programme_elements)
+        phases.measure('create_xml_file (countries)', create_xml_files)
+        phases.measure('create_xml_file (all)', create_xml_all)
+        phases.measure('create_xml_file (steady)', create_xml_steady)
+        phases.measure('channels_all', channels_all)
+        phases.measure('playlist render', playlist_render)
+        phases.measure('playlist requests', lambda: get('/pluto/all/playlist.m3u', args.requests // 10),
+                       operations=args.requests // 10)
+        phases.measure('watch redirects', watch, operations=args.requests)
+        phases.measure('watch proxied', watch_proxied, operations=args.requests // 20 * 20)
+        phases.measure('watch during render', watch_during_render)
+
+        sizes = {name: os.path.getsize(name) for name in sorted(os.listdir(workdir)) if name.startswith('epg-')}
+        return {'config': {'channels': args.channels, 'countries': countries, 'hours': args.hours,
+                           'concurrency': args.concurrency, 'render_workers': args.render_workers,
+                           'gzip_level': args.gzip_level, 'gzip_threads': args.gzip_threads,
+                           'fragment_cache': not args.no_fragment_cache,
+                           'fixtures': args.fixtures},
+                'watch_during_render': getattr(phases, 'watch_latency', None),
+                'programmes': getattr(phases, 'programmes', 0),
+                'files': sizes,
+                'phases': phases.results}
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, result in report['phases'].items():
+        before = baseline['phases'].get(name)
+        if before is None:
+            continue
+        for metric in ('seconds', 'peak_rss_kb', 'requests'):
+            old, new = before.get(metric, 0), result.get(metric, 0)
+            if metric == 'peak_rss_kb' and not (result.get('peak_rss_reset') and before.get('peak_rss_reset')):
+                continue
+            # Requests are exact, timings and memory get the tolerance
+            limit = old if metric == 'requests' else old * (1 + tolerance)
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            flag = new > limit
+            print(f"  {name:<28} {metric:<12} {old:>12} -> {new:<12} {change:>8}{'  REGRESSION' if flag else ''}")
+            if flag:
+                regressions.append((name, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=400)
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--countries', default='local,ca,uk')
+    parser.add_argument('--hours', type=int, default=36)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--render-workers', type=int, default=0)
+    parser.add_argument('--gzip-level', type=int, default=9)
+    parser.add_argument('--gzip-threads', type=int, default=1)
+    parser.add_argument('--no-fragment-cache', action='store_true')
+    parser.add_argument('--fixtures')
+    parser.add_argument('--json', dest='json_path')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+    json_path = args.json_path and os.path.abspath(args.json_path)
+    compare_path = args.compare and os.path.abspath(args.compare)
+
+    report = run(args)
+    print(f"{report['programmes']} programmes rendered")
+    for name, size in report['files'].items():
+        print(f"  {name:<28} {size / 1024:10.1f} KiB")
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    if compare_path:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+        print(f"Compared with {compare_path}:")
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
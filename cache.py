@@ -0,0 +1,60 @@
+import json, sqlite3, time
+
+# Default time-to-live in seconds for each kind of cached upstream response
+DEFAULT_TTL = {
+    'boot': 4 * 60 * 60,
+    'channels': 30 * 60,
+    'categories': 30 * 60,
+    'timelines': 2 * 60 * 60,
+}
+
+# Seconds expired rows are kept. Only the lineups are read with stale=True (by
+# a warm start); expired boot sessions and guide pages are never read again.
+DEFAULT_GRACE = {
+    'channels': 24 * 60 * 60,
+    'categories': 24 * 60 * 60,
+}
+
+
+class ResponseCache:
+    # SQLite-backed store of upstream responses so a restarted container can
+    # answer from what it already fetched. Every row carries the time it was
+    # stored and when it expires; expired rows can still be read with
+    # stale=True to serve something while a refresh runs.
+    def __init__(self, path, ttl=None, grace=None):
+        self.path = path
+        self.ttl = dict(DEFAULT_TTL, **(ttl or {}))
+        self.grace = dict(DEFAULT_GRACE, **(grace or {}))
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                               kind TEXT NOT NULL,
+                               key TEXT NOT NULL,
+                               value TEXT NOT NULL,
+                               stored REAL NOT NULL,
+                               expires REAL NOT NULL,
+                               PRIMARY KEY (kind, key))""")
+
+    def get(self, kind, key, stale=False):
+        row = self.db.execute("SELECT value, stored, expires FROM responses WHERE kind = ? AND key = ?",
+                              (kind, key)).fetchone()
+        if row is None or (not stale and row[2] <= time.time()):
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def set(self, kind, key, value, ttl=None, stored=None):
+        stored = time.time() if stored is None else stored
+        expires = stored + (self.ttl[kind] if ttl is None else ttl)
+        self.db.execute("INSERT OR REPLACE INTO responses (kind, key, value, stored, expires) VALUES (?, ?, ?, ?, ?)",
+                        (kind, key, json.dumps(value, separators=(',', ':')), stored, expires))
+
+    def purge(self):
+        # Timeline keys carry the window start, so every refresh stores new pages
+        # and expired ones have to go straight away or the file keeps growing
+        now = time.time()
+        kinds = tuple(self.grace)
+        self.db.execute(f"DELETE FROM responses WHERE expires < ? AND kind NOT IN ({', '.join('?' * len(kinds))})",
+                        (now, *kinds))
+        for kind, grace in self.grace.items():
+            self.db.execute("DELETE FROM responses WHERE kind = ? AND expires < ?", (kind, now - grace))
@@ -0,0 +1,7 @@
+# Starts the server. Render workers are spawned processes that re-run the
+# __main__ module; this one does nothing there, so a worker only imports what
+# render_guide needs and never pywsgi, which monkey-patches gevent and opens
+# the cache when it is imported.
+if __name__ == '__main__':
+    import pywsgi
+    pywsgi.main()
@@ -0,0 +1,151 @@
+import math, time
+from threading import Lock
+
+# Prometheus text exposition without the client library. Metrics are module
+# level so pluto.py and pywsgi.py record into the same registry that /metrics
+# renders.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labelnames, key), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = (*sorted(buckets), math.inf)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labelnames, key, [('le', format_value(float(bound)))])
+                    samples.append((f"{self.name}_bucket", labels, cumulative))
+                labels = format_labels(self.labelnames, key)
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Timer:
+    # with histogram.time(phase='gzip'): ... observes the elapsed seconds
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.started
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+UPSTREAM_REQUESTS = Counter('pluto_upstream_requests_total', 'Requests made to the Pluto API.',
+                            ('endpoint', 'country', 'status'))
+UPSTREAM_LATENCY = Histogram('pluto_upstream_request_seconds', 'Latency of requests made to the Pluto API.',
+                             ('endpoint', 'country'))
+TOKEN_CACHE = Counter('pluto_token_cache_total', 'Session token lookups by result (hit, restored or miss).',
+                      ('country', 'result'))
+EPG_PHASE = Histogram('pluto_epg_phase_seconds', 'Time spent in each phase of building an EPG file.',
+                      ('file', 'phase'))
+EPG_ARTIFACT_BYTES = Gauge('pluto_epg_artifact_bytes', 'Size of the last published EPG file.', ('file',))
+EPG_PROGRAMMES = Gauge('pluto_epg_programmes', 'Programmes in the last published EPG file.', ('file',))
+EPG_CHANNELS = Gauge('pluto_epg_channels', 'Channels in the last published EPG file.', ('file',))
+EPG_FRAGMENTS = Counter('pluto_epg_fragments_total', 'Programmes written from the fragment cache or rendered, by file.',
+                        ('file', 'result'))
+EPG_FRAGMENT_CACHE_ENTRIES = Gauge('pluto_epg_fragment_cache_entries', 'Rendered programme fragments held for the next refresh of each file.',
+                                   ('file',))
+EPG_GZIP_RATIO = Gauge('pluto_epg_gzip_ratio', 'Uncompressed over compressed size of the last published .xml.gz.', ('file',))
+EPG_GZIP_THROUGHPUT = Gauge('pluto_epg_gzip_bytes_per_second', 'Uncompressed bytes per second of time spent compressing the last .xml.gz.',
+                            ('file',))
+HTTP_LATENCY = Histogram('pluto_http_request_seconds', 'Latency of requests served by this app.',
+                         ('route', 'status'))
@@ -1,17 +1,491 @@
-import uuid, requests, json, pytz, gzip, re
+import uuid, json, pytz, os, sys, hashlib, time, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 import xml.etree.ElementTree as ET
+from gevent.pool import Pool
+from threading import Lock
+from cache import ResponseCache
+from transport import build_session
+import metrics
+import sanitize
+from xmltv import XMLTVWriter, xmltv_time, xmltv_air_date, xmltv_date
+
+SERIES_GENRES = {
+    ("Animated",): ["Family Animation", "Cartoons"],
+    ("Educational",): ["Education & Guidance", "Instructional & Educational"],
+    ("News",): ["News and Information", "General News", "News + Opinion", "General News"],
+    ("History",): ["History & Social Studies"],
+    ("Politics",): ["Politics"],
+    ("Action",):
+        [
+          "Action & Adventure",
+          "Action Classics",
+          "Martial Arts",
+          "Crime Action",
+          "Family Adventures",
+          "Action Sci-Fi & Fantasy",
+          "Action Thrillers",
+          "African-American Action",
+        ],
+    ("Adventure",): ["Action & Adventure", "Adventures", "Sci-Fi Adventure"],
+    ("Reality",):
+        [
+          "Reality",
+          "Reality Drama",
+          "Courtroom Reality",
+          "Occupational Reality",
+          "Celebrity Reality",
+        ],
+    ("Documentary",):
+        [
+          "Documentaries",
+          "Social & Cultural Documentaries",
+          "Science and Nature Documentaries",
+          "Miscellaneous Documentaries",
+          "Crime Documentaries",
+          "Travel & Adventure Documentaries",
+          "Sports Documentaries",
+          "Military Documentaries",
+          "Political Documentaries",
+          "Foreign Documentaries",
+          "Religion & Mythology Documentaries",
+          "Historical Documentaries",
+          "Biographical Documentaries",
+          "Faith & Spirituality Documentaries",
+        ],
+    ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
+    ("Science Fiction",): ["Sci-Fi Thrillers", "Sci-Fi Adventure", "Action Sci-Fi & Fantasy"],
+    ("Thriller",): ["Sci-Fi Thrillers", "Thrillers", "Crime Thrillers"],
+    ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
+    ("Talk",): ["Talk & Variety", "Talk Show"],
+    ("Variety",): ["Sketch Comedies"],
+    ("Home Improvement",): ["Art & Design", "DIY & How To", "Home Improvement"],
+    ("House/garden",): ["Home & Garden"],
+    # ("Science",): ["Science and Nature Documentaries"],
+    # ("Nature",): ["Science and Nature Documentaries", "Animals"],
+    ("Cooking",): ["Cooking Instruction", "Food & Wine", "Food Stories"],
+    ("Travel",): ["Travel & Adventure Documentaries", "Travel"],
+    ("Western",): ["Westerns", "Classic Westerns"],
+    ("LGBTQ",): ["Gay & Lesbian", "Gay & Lesbian Dramas", "Gay"],
+    ("Game show",): ["Game Show"],
+    ("Military",): ["Classic War Stories"],
+    ("Comedy",):
+        [
+          "Cult Comedies",
+          "Spoofs and Satire",
+          "Slapstick",
+          "Classic Comedies",
+          "Stand-Up",
+          "Sports Comedies",
+          "African-American Comedies",
+          "Showbiz Comedies",
+          "Sketch Comedies",
+          "Teen Comedies",
+          "Latino Comedies",
+          "Family Comedies",
+        ],
+    ("Crime",): ["Crime Action", "Crime Drama", "Crime Documentaries"],
+    ("Sports",): ["Sports","Sports & Sports Highlights","Sports Documentaries", "Poker & Gambling"],
+    ("Poker & Gambling",): ["Poker & Gambling"],
+    ("Crime drama",): ["Crime Drama"],
+    ("Drama",):
+        [
+          "Classic Dramas",
+          "Family Drama",
+          "Indie Drama",
+          "Romantic Drama",
+          "Crime Drama",
+        ],
+    ("Children",): ["Kids", "Children & Family", "Kids' TV", "Cartoons", "Animals", "Family Animation", "Ages 2-4", "Ages 11-12",],
+    ("Animated",): ["Family Animation", "Cartoons"]
+    }
+
+class GenreMap:
+    # Reverse index from a Pluto genre to its XMLTV categories, compiled once.
+    # The category tuple for each (genre, series type, subGenre) combination is
+    # memoised so the per-programme lookup is a single dict hit.
+    def __init__(self, series_genres):
+        lookup = {}
+        for key, values in series_genres.items():
+            categories = (key,) if isinstance(key, str) else key
+            for value in values:
+                entry = lookup.setdefault(value, [])
+                for category in categories:
+                    if category not in entry:
+                        entry.append(category)
+        self.lookup = {value: tuple(categories) for value, categories in lookup.items()}
+        self._combined = {}
+
+    @classmethod
+    def from_file(cls, path):
+        # JSON object of {"XMLTV category": ["Pluto genre", ...]}
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def categories(self, genre, series_type, sub_genre):
+        key = (genre, series_type, sub_genre)
+        result = self._combined.get(key)
+        if result is None:
+            categories = []
+            if genre is not None:
+                categories.extend(self.lookup.get(genre, (genre,)))
+            if series_type == "tv":
+                categories.append("Series")
+            if series_type == "film":
+                categories.append("Movie")
+            if sub_genre is not None:
+                categories.extend(self.lookup.get(sub_genre, (sub_genre,)))
+            result = tuple(dict.fromkeys(categories))
+            self._combined[key] = result
+        return result
+
+DEFAULT_GENRE_MAP = GenreMap(SERIES_GENRES)
+
+def load_json(path, default):
+    if path and os.path.exists(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[ERROR] Unable to load {path}: {e}")
+    return default
+
+def write_json(path, data):
+    # Write next to the target and rename over it so readers never see a partial file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+class ChannelNumberAllocator:
+    # Hands out unique channel numbers, bumping a taken number to the next free
+    # one. Runs of taken numbers are skipped through a path-compressed "next
+    # free" map, so allocating a whole lineup is linear instead of quadratic.
+    def __init__(self):
+        self.taken = set()
+        self.next_free = {}
+
+    def find(self, number):
+        path = []
+        while number in self.taken:
+            path.append(number)
+            number = self.next_free.get(number, number + 1)
+        for taken in path:
+            self.next_free[taken] = number
+        return number
+
+    def reserve(self, number):
+        if number in self.taken:
+            return False
+        self.taken.add(number)
+        return True
+
+    def allocate(self, number):
+        if number is None:
+            return None
+        number = self.find(number)
+        self.taken.add(number)
+        return number
+
+def programme_element(channel_id, timeline, genre_map):
+    # Create programme element
+    programme = ET.Element("programme", attrib={"channel": channel_id,
+                                                "start": xmltv_time(timeline.start),
+                                                "stop": xmltv_time(timeline.stop)})
+    # Add sub-elements to programme
+    # Text fields were sanitised when the timeline was ingested
+    title = ET.SubElement(programme, "title")
+    title.text = timeline.title
+    if timeline.series_type == "live":
+        if timeline.release_date == timeline.start:
+            live = ET.SubElement(programme, "live")
+        if timeline.season:
+            episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
+            episode_num_onscreen.text = f'S{timeline.season:02d}E{timeline.number:02d}'
+            episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
+            episode_num_pluto.text = timeline.episode_id
+    elif timeline.series_type == "tv":
+        episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
+        episode_num_onscreen.text = f'S{timeline.season:02d}E{timeline.number:02d}'
+        episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
+        episode_num_pluto.text = timeline.episode_id
+    episode_num_air_date = ET.SubElement(programme, "episode-num", attrib={"system": "original-air-date"})
+    episode_num_air_date.text = xmltv_air_date(timeline.release_date)
+    desc = ET.SubElement(programme, "desc")
+    desc.text = timeline.description
+    icon_programme = ET.SubElement(programme, "icon", attrib={"src": timeline.tile})
+    date = ET.SubElement(programme, "date")
+    date.text = xmltv_date(timeline.release_date)
+    # if timeline["episode"].get("series", {}).get("type", "") == "tv":
+    series_id_pluto = ET.SubElement(programme, "series-id", attrib={"system": "pluto"})
+    series_id_pluto.text = timeline.series_id
+    if timeline.title.lower() != timeline.name.lower():
+        sub_title = ET.SubElement(programme, "sub-title")
+        sub_title.text = timeline.name
+    categories = genre_map.categories(timeline.genre, timeline.series_type, timeline.sub_genre)
+    for category in categories:
+        category_elem = ET.SubElement(programme, "category")
+        category_elem.text = category
+
+    return programme
+
+def render_guide(xml_file_path, compressed_file_path, station_list, program_data, genre_map, version,
+                 gzip_level=9, gzip_threads=1, cache_fragments=False):
+    # Builds, serialises and compresses one guide file. Runs in a render worker
+    # process when they are enabled, so it only takes picklable arguments.
+    #
+    # With cache_fragments, programmes already serialised by an earlier render
+    # in this process are written from FRAGMENT_CACHES instead of built again.
+    started = time.perf_counter()
+    previous = FRAGMENT_CACHES.get(xml_file_path, {})
+    others = [cache for path, cache in FRAGMENT_CACHES.items() if path != xml_file_path]
+    kept = {}
+    cached = rendered = 0
+    with XMLTVWriter(xml_file_path, compressed_file_path, attrib={"generator-info-name": "jgomez177", "generated-ts": ""},
+                     version=version, gzip_level=gzip_level, gzip_threads=gzip_threads) as writer:
+        # Create Channel Elements from list of Stations
+        for station in station_list:
+            channel = ET.Element("channel", attrib={"id": station["id"]})
+            display_name = ET.SubElement(channel, "display-name")
+            display_name.text = station["name"]
+            icon = ET.SubElement(channel, "icon", attrib={"src": station["logo"]})
+            writer.write(channel)
+
+        # Create Programme Elements
+        for page in program_data:
+            for entry in page["data"]:
+                for timeline in entry["timelines"]:
+                    if not cache_fragments:
+                        writer.write(programme_element(entry["channelId"], timeline, genre_map))
+                        continue
+                    key = (entry["channelId"], timeline.values())
+                    fragment = previous.get(key)
+                    if fragment is None:
+                        # epg-all finds the programmes of country files rendered here
+                        fragment = next((cache[key] for cache in others if key in cache), None)
+                    if fragment is None:
+                        fragment = writer.serialize(programme_element(entry["channelId"], timeline, genre_map))
+                        rendered += 1
+                    else:
+                        cached += 1
+                    kept[key] = fragment
+                    writer.write_fragment(fragment)
+
+    # Only the programmes of this render are kept, so ended ones drop out without an expiry pass
+    if cache_fragments:
+        FRAGMENT_CACHES[xml_file_path] = kept
+
+    # The writer times serialising, compressing and writing, the rest of the pass is building elements
+    timings = dict(writer.timings)
+    timings['build'] = time.perf_counter() - started - sum(writer.timings.values())
+    fragments = {'cached': cached, 'rendered': rendered, 'entries': len(kept)} if cache_fragments else None
+    return {'timings': timings, 'element_count': writer.element_count, 'fragments': fragments}
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class Programme:
+    # The parts of a Pluto timeline that end up in the guide. Ids, genres,
+    # titles and image URLs repeat across thousands of programmes and every
+    # country, so strings are interned and only one copy is kept. Text is
+    # sanitised for XML here, once per programme.
+    __slots__ = ('start', 'stop', 'title', 'episode_id', 'season', 'number', 'name', 'description',
+                 'genre', 'sub_genre', 'series_id', 'series_type', 'tile', 'release_date')
+
+    def __init__(self, timeline):
+        episode = timeline.get('episode') or {}
+        series = episode.get('series') or {}
+        self.start = intern(timeline['start'])
+        self.stop = intern(timeline['stop'])
+        self.title = intern(sanitize.xml_text(timeline.get('title', '')))
+        self.episode_id = intern(episode.get('_id'))
+        self.season = episode.get('season')
+        self.number = episode.get('number')
+        self.name = intern(sanitize.xml_text(episode.get('name', '')))
+        self.description = intern(sanitize.description(episode.get('description', '')))
+        self.genre = intern(episode.get('genre'))
+        self.sub_genre = intern(episode.get('subGenre'))
+        self.series_id = intern(series.get('_id'))
+        self.series_type = intern(series.get('type', ''))
+        self.tile = intern((series.get('tile') or {}).get('path'))
+        self.release_date = intern((episode.get('clip') or {}).get('originalReleaseDate'))
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __reduce__(self):
+        # Pickled as a plain tuple, render workers receive tens of thousands of these
+        return (restore_programme, (self.values(),))
+
+    def as_dict(self):
+        # The layout of the upstream timeline, limited to the fields kept
+        return {'start': self.start, 'stop': self.stop, 'title': self.title,
+                'episode': {'_id': self.episode_id, 'season': self.season, 'number': self.number, 'name': self.name,
+                            'description': self.description, 'genre': self.genre, 'subGenre': self.sub_genre,
+                            'clip': {'originalReleaseDate': self.release_date},
+                            'series': {'_id': self.series_id, 'type': self.series_type, 'tile': {'path': self.tile}}}}
+
+def restore_programme(values):
+    programme = Programme.__new__(Programme)
+    for name, value in zip(Programme.__slots__, values):
+        setattr(programme, name, value)
+    return programme
+
+def ingest_page(page):
+    # Convert a /v2/guide/timelines response into (channelId, programmes) pairs
+    # straight away so the raw JSON can be freed
+    return [(intern(entry['channelId']), [Programme(timeline) for timeline in entry.get('timelines', [])])
+            for entry in page.get('data', [])]
+
+def page_json(page):
+    return {'data': [{'channelId': entry['channelId'], 'timelines': [p.as_dict() for p in entry['timelines']]}
+                     for entry in page['data']]}
+
+# Serialised <programme> fragments of the last render of each file, keyed by
+# channel and the full content of the programme, so a refresh only builds the
+# programmes that are new or changed. They live in the process that renders:
+# a render worker when they are enabled, which always gets the same files.
+FRAGMENT_CACHES = {}
+
+class TimelineStore:
+    # Programmes for one country keyed by (channelId, start), so overlapping or
+    # re-fetched windows never duplicate a programme. Each programme remembers
+    # the window it was first fetched in, which keeps the page layout stable.
+    def __init__(self):
+        self.programmes = {}
+        self.channel_ids = set()
+        self.horizon = None      # end of the furthest window fetched
+        self.validated = None    # when the window starting now was last fetched
+
+    def add(self, window, entries):
+        for channel_id, programmes in entries:
+            self.channel_ids.add(channel_id)
+            for programme in programmes:
+                key = (channel_id, programme.start)
+                existing = self.programmes.get(key)
+                self.programmes[key] = (existing[0] if existing else window, programme)
+
+    def discard_range(self, channel_ids, start, stop):
+        # Forget what a re-fetched window covers so cancelled programmes disappear
+        channel_ids = set(channel_ids)
+        for key in [key for key in self.programmes if key[0] in channel_ids and start <= key[1] < stop]:
+            del self.programmes[key]
+
+    def expire(self, now, channel_ids):
+        # Drop programmes that have already ended and channels no longer in the lineup
+        channel_ids = set(channel_ids)
+        for key, (_, programme) in list(self.programmes.items()):
+            if programme.stop <= now or key[0] not in channel_ids:
+                del self.programmes[key]
+        self.channel_ids &= channel_ids
+
+    def pages(self, channel_ids):
+        windows = {}
+        for (channel_id, _), (window, programme) in self.programmes.items():
+            windows.setdefault(window, {}).setdefault(channel_id, []).append(programme)
+
+        pages = []
+        for window in sorted(windows):
+            channels = windows[window]
+            data = [{'channelId': channel_id, 'timelines': sorted(channels[channel_id], key=lambda p: p.start)}
+                    for channel_id in channel_ids if channel_id in channels]
+            pages.append({'data': data})
+        return pages
+
+# Channel numbers in the merged lineup are moved into a per-region block
+REGION_OFFSETS = {
+    'ca': 6000,
+    'uk': 7000,
+    'fr': 8000,
+    'de': 9000,
+}
+
+class Lineup:
+    # Read-only snapshot of the merged "all" lineup. The stations are copies,
+    # renumbering them never touches the per-country lineups they came from.
+    # sources holds the per-country lists it was built from, a snapshot is
+    # current for as long as Client.all_channels still holds the same lists.
+    def __init__(self, stations, sources):
+        self.stations = tuple(stations)
+        self.sources = sources
+
+    def is_current(self, all_channels):
+        return (len(self.sources) == len(all_channels) and
+                all(country == key and stations is all_channels.get(key)
+                    for (country, stations), key in zip(self.sources, all_channels)))
 
 class Client:
-    def __init__(self, username=None, password=None):
-        self.session = requests.Session()
+    # Upstream hosts, the offline benchmarks point these at a local stand-in
+    boot_url = "https://boot.pluto.tv"
+    service_url = "https://service-channels.clusters.pluto.tv"
+
+    def __init__(self, username=None, password=None, epg_concurrency=4, genre_map_path=None, channel_map_path=None,
+                 epg_incremental=False, epg_revalidate_hours=6, cache_path=None, pool_size=None,
+                 connect_timeout=5, read_timeout=30, retries=3, render_workers=0, gzip_level=9, gzip_threads=1,
+                 fragment_cache=True):
         self.sessionAt = {}
         self.response_list = {}
         self.epg_data = {}
         self.device = None
         self.all_channels = {}
+        self.all_lineup = None
+
         self.username = username
         self.password = password
+        # Number of /v2/guide/timelines requests allowed in flight at once
+        self.epg_concurrency = max(1, epg_concurrency)
+        # Enough pooled connections for every timeline request in flight plus the
+        # boot and channel calls made alongside them
+        self.pool_size = pool_size or max(10, self.epg_concurrency + 2)
+        self.session = build_session(self.pool_size, connect_timeout, read_timeout, retries)
+        # Guide files are rendered in this many worker processes, 0 renders in
+        # this process. The gevent hub only waits for the result. Each scheduled
+        # job renders its own file, more workers let overlapping jobs run side by side.
+        self.render_workers = render_workers
+        self.render_executors = {}
+        self.render_slots = {}
+        # Threads compressing each .xml.gz. They only run in parallel inside a
+        # render worker, on the hub they would take turns.
+        self.gzip_level = gzip_level
+        self.gzip_threads = gzip_threads if render_workers else 1
+        # Rendered <programme> fragments reused by the next refresh, see FRAGMENT_CACHES
+        self.fragment_cache = fragment_cache
+
+        # Incremental refreshes keep a TimelineStore per country and only fetch the
+        # newly exposed tail window, re-fetching the current window every few hours
+        self.epg_incremental = epg_incremental
+        self.epg_revalidate = timedelta(hours=epg_revalidate_hours) if epg_revalidate_hours else None
+        self.timeline_stores = {}
+
+        # Boot tokens are kept for token_ttl and renewed in the background once
+        # they are within token_refresh_margin of it
+        self.token_ttl = timedelta(hours=4)
+        self.token_refresh_margin = timedelta(minutes=30)
+        self.boot_locks = {}
+
+        # Optional on-disk cache of upstream responses that survives restarts
+        self.cache = None
+        if cache_path:
+            try:
+                self.cache = ResponseCache(cache_path)
+            except Exception as e:
+                print(f"[ERROR] Unable to open cache {cache_path}: {e}")
+        self.genre_map = DEFAULT_GENRE_MAP
+        if genre_map_path:
+            try:
+                self.genre_map = GenreMap.from_file(genre_map_path)
+                print(f"[INFO] Loaded genre map from {genre_map_path}")
+            except Exception as e:
+                print(f"[ERROR] Unable to load genre map {genre_map_path}: {e}")
+
+        # Optional channel-id -> number map per lineup, kept across refreshes and restarts
+        self.channel_map_path = channel_map_path
+        self.channel_numbers = load_json(channel_map_path, {})
+
+        # Generation of every published EPG artifact, bumped each time a new guide is swapped in
+        self.generation_path = "epg-generation.json"
+        self.epg_generation = load_json(self.generation_path, {})
 
         self.load_device()
         self.x_forward = {"local": {"X-Forwarded-For":""},
@@ -27,12 +501,70 @@ class Client:
             self.device = uuid.uuid1()
         return(self.device)
 
+    def session_age(self, country_code):
+        sessionAt = self.sessionAt.get(country_code)
+        if self.response_list.get(country_code) is None or sessionAt is None:
+            return None
+        return datetime.now(pytz.utc) - sessionAt
+
     def resp_data(self, country_code):
-        desired_timezone = pytz.timezone('UTC')
-        current_date = datetime.now(desired_timezone)
-        if (self.response_list.get(country_code) is not None) and (current_date - self.sessionAt.get(country_code, datetime.now())) < timedelta(hours=4):
+        age = self.session_age(country_code)
+        if age is not None and age < self.token_ttl:
+            metrics.TOKEN_CACHE.inc(country=country_code, result='hit')
             return self.response_list[country_code], None
 
+        # Single flight: concurrent callers wait for the one boot request in progress
+        with self.boot_lock(country_code):
+            age = self.session_age(country_code)
+            if age is not None and age < self.token_ttl:
+                metrics.TOKEN_CACHE.inc(country=country_code, result='hit')
+                return self.response_list[country_code], None
+
+            # A session saved before a restart stays usable until it expires
+            if self.cache:
+                cached, stored = self.cache.get('boot', country_code)
+                if cached is not None:
+                    metrics.TOKEN_CACHE.inc(country=country_code, result='restored')
+                    self.response_list.update({country_code: cached})
+                    self.sessionAt.update({country_code: datetime.fromtimestamp(stored, pytz.utc)})
+                    return cached, None
+
+            metrics.TOKEN_CACHE.inc(country=country_code, result='miss')
+            return self.boot(country_code)
+
+    def upstream_get(self, endpoint, country_code, url, **kwargs):
+        # Every call to the Pluto API goes through here so it is counted and timed
+        started = time.perf_counter()
+        try:
+            response = self.session.get(url, **kwargs)
+        except Exception as e:
+            metrics.UPSTREAM_REQUESTS.inc(endpoint=endpoint, country=country_code, status=type(e).__name__)
+            raise
+        finally:
+            metrics.UPSTREAM_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, country=country_code)
+        metrics.UPSTREAM_REQUESTS.inc(endpoint=endpoint, country=country_code, status=response.status_code)
+        return response
+
+    def boot_lock(self, country_code):
+        return self.boot_locks.setdefault(country_code, Lock())
+
+    def refresh_tokens(self, country_list):
+        # Renew tokens that are close to expiring while the current one is still
+        # served, so no request has to wait for boot.pluto.tv
+        for country_code in country_list:
+            age = self.session_age(country_code)
+            if age is not None and age < self.token_ttl - self.token_refresh_margin:
+                continue
+            lock = self.boot_lock(country_code)
+            if lock.locked():
+                continue
+            with lock:
+                resp, error = self.boot(country_code)
+            if error: print(f"[ERROR] Token refresh for {country_code} failed: {error}")
+
+    def boot(self, country_code):
+        current_date = datetime.now(pytz.utc)
+
         boot_headers = {
             'authority': 'boot.pluto.tv',
             'accept': '*/*',
@@ -73,7 +605,7 @@ class Client:
             boot_headers.update(self.x_forward.get(country_code))
 
         try:
-            response = self.session.get('https://boot.pluto.tv/v4/start', headers=boot_headers, params=boot_params)
+            response = self.upstream_get('boot', country_code, f'{self.boot_url}/v4/start', headers=boot_headers, params=boot_params)
         except Exception as e:
             return None, (f"Error Exception type: {type(e).__name__}")
 
@@ -86,6 +618,8 @@ class Client:
         # Save entire Response:
         self.response_list.update({country_code: resp})
         self.sessionAt.update({country_code: current_date})
+        if self.cache:
+            self.cache.set('boot', country_code, resp, stored=current_date.timestamp())
         print(f"New token for {country_code} generated at {(self.sessionAt.get(country_code)).strftime('%Y-%m-%d %H:%M.%S %z')}")
 
         return self.response_list.get(country_code), None
@@ -94,13 +628,27 @@ class Client:
         if country_code == 'all':
             return(self.channels_all())
 
+        channel_list, categories_data = None, None
+        if self.cache:
+            channel_list, _ = self.cache.get('channels', country_code)
+            categories_data, _ = self.cache.get('categories', country_code)
+
+        if channel_list is None or categories_data is None:
+            channel_list, categories_data, error = self.fetch_channel_lists(country_code)
+            if error: return None, error
+
+        sorted_data = self.build_stations(country_code, channel_list, categories_data)
+        self.all_channels.update({country_code: sorted_data})
+        return(sorted_data, None)
+
+    def fetch_channel_lists(self, country_code):
         resp, error = self.resp_data(country_code)
-        if error: return None, error
+        if error: return None, None, error
 
         token = resp.get('sessionToken', None)
-        if token is None: return None, error
+        if token is None: return None, None, error
 
-        url = f"https://service-channels.clusters.pluto.tv/v2/guide/channels"
+        url = f"{self.service_url}/v2/guide/channels"
 
         headers = {
             'authority': 'service-channels.clusters.pluto.tv',
@@ -122,27 +670,33 @@ class Client:
             headers.update(self.x_forward.get(country_code))
 
         try:
-            response = self.session.get(url, params=params, headers=headers)
+            response = self.upstream_get('channels', country_code, url, params=params, headers=headers)
         except Exception as e:
-            return None, (f"Error Exception type: {type(e).__name__}")
+            return None, None, (f"Error Exception type: {type(e).__name__}")
 
         if response.status_code != 200:
-            return None, f"HTTP failure {response.status_code}: {response.text}"
+            return None, None, f"HTTP failure {response.status_code}: {response.text}"
 
         channel_list = response.json().get("data")
 
-        category_url = f"https://service-channels.clusters.pluto.tv/v2/guide/categories"
+        category_url = f"{self.service_url}/v2/guide/categories"
 
         try:
-            response = self.session.get(category_url, params=params, headers=headers)
+            response = self.upstream_get('categories', country_code, category_url, params=params, headers=headers)
         except Exception as e:
-            return None, (f"Error Exception type: {type(e).__name__}")
+            return None, None, (f"Error Exception type: {type(e).__name__}")
         
         if response.status_code != 200:
-            return None, f"HTTP failure {response.status_code}: {response.text}"
+            return None, None, f"HTTP failure {response.status_code}: {response.text}"
 
         categories_data = response.json().get("data")
 
+        if self.cache:
+            self.cache.set('channels', country_code, channel_list)
+            self.cache.set('categories', country_code, categories_data)
+        return channel_list, categories_data, None
+
+    def build_stations(self, country_code, channel_list, categories_data):
         categories_list = {}
         for elem in categories_data:
             category = elem.get('name')
@@ -152,87 +706,103 @@ class Client:
 
         stations = []
         for elem in channel_list:
+            # Names go into the XMLTV file and summaries into M3U attributes, clean them once here
             entry = {'id': elem.get('id'),
-                    'name': elem.get('name'),
+                    'name': sanitize.xml_text(elem.get('name')),
                     'slug': elem.get('slug'),
                     'tmsid': elem.get('tmsid'),
-                    'summary': elem.get('summary'),
+                    'summary': sanitize.printable(elem.get('summary')),
                     'group': categories_list.get(elem.get('id')),
                     'country_code': country_code}
 
-            # Ensure number value is unique
-            number = elem.get('number')
-            existing_numbers = {channel["number"] for channel in stations}
-            while number in existing_numbers:
-                # print(f"Updating channel number for {elem.get('name')}")
-                number += 1
-
             # Filter the list to find the element with "type" equal to "colorLogoPNG"
             color_logo_png = next((image["url"] for image in elem["images"] if image["type"] == "colorLogoPNG"), None)
-            entry.update({'number': number, 'logo': color_logo_png})
+            entry.update({'number': elem.get('number'), 'logo': color_logo_png})
 
             stations.append(entry)
 
+        # Ensure number value is unique
+        self.assign_channel_numbers(country_code, stations)
+
         sorted_data = sorted(stations, key=lambda x: x["number"])
         # print(json.dumps(sorted_data[0], indent = 2))
-
-        self.all_channels.update({country_code: sorted_data})
-        return(sorted_data, None)
+        return sorted_data
+
+    def warm_start(self, country_list):
+        # Load the last lineups the cache holds, however old, so a restarted
+        # server can answer straight away while the scheduler refreshes them
+        if self.cache is None:
+            return
+        for country in country_list:
+            channel_list, _ = self.cache.get('channels', country, stale=True)
+            categories_data, _ = self.cache.get('categories', country, stale=True)
+            if channel_list is None or categories_data is None:
+                continue
+            self.all_channels.update({country: self.build_stations(country, channel_list, categories_data)})
+        print(f"[INFO] Warm start loaded cached lineups for {', '.join(self.all_channels.keys()) or 'no countries'}")
 
     def channels_all(self):
-        all_channel_list = []
-        for key, val in self.all_channels.items():
-            all_channel_list.extend(val)
-
-        # Using a set to keep track of slugs that have been seen and filter unique ones
-        seen = set()
-        filter_key = 'id'
-        filtered_list = [d for d in all_channel_list if d[filter_key] not in seen and not seen.add(d[filter_key])]
+        # The merged lineup is rebuilt only after a country lineup has changed
+        lineup = self.all_lineup
+        if lineup is None or not lineup.is_current(self.all_channels):
+            lineup = self.build_all_lineup()
+        return(lineup.stations, None)
 
+    def build_all_lineup(self):
+        sources = tuple(self.all_channels.items())
 
+        # The first country carrying a channel keeps it, later copies are dropped
         seen = set()
-        for elem in filtered_list:
-            # Ensure number value is unique
-            number = elem.get('number')
-            match elem.get('country_code').lower():
-                case 'ca':
-                    offset = 6000
-                    if number < offset:
-                        number += offset
-                case 'uk':
-                    offset = 7000
-                    if number < offset:
-                        number += offset
-                case 'fr':
-                    offset = 8000
-                    if number < offset:
-                        number += offset
-                case 'de':
-                    offset = 9000
-                    if number < offset:
-                        number += offset
-        
-            while number in seen:
-                number += 1
-            seen.add(number)
-            if number != elem.get('number'):
-                elem.update({'number': number})
-
-        return(filtered_list, None)
+        merged = []
+        for country, stations in sources:
+            offset = REGION_OFFSETS.get(country.lower(), 0)
+            for station in stations:
+                if station['id'] in seen:
+                    continue
+                seen.add(station['id'])
+                station = dict(station)
+                if station['number'] < offset:
+                    station['number'] += offset
+                merged.append(station)
+
+        # Ensure number value is unique
+        self.assign_channel_numbers('all', merged)
+
+        self.all_lineup = Lineup(merged, sources)
+        return self.all_lineup
+
+    def assign_channel_numbers(self, scope, stations):
+        allocator = ChannelNumberAllocator()
+        pinned = self.channel_numbers.get(scope, {}) if self.channel_map_path else {}
+
+        # Numbers remembered from earlier refreshes are claimed first so they stay stable
+        unassigned = []
+        for station in stations:
+            number = pinned.get(station['id'])
+            if number is not None and allocator.reserve(number):
+                station['number'] = number
+            else:
+                unassigned.append(station)
+
+        for station in unassigned:
+            station['number'] = allocator.allocate(station['number'])
+
+        if self.channel_map_path:
+            numbers = {station['id']: station['number'] for station in stations}
+            if any(pinned.get(key) != value for key, value in numbers.items()):
+                self.channel_numbers[scope] = {**pinned, **numbers}
+                self.save_channel_numbers()
+        return stations
+
+    def save_channel_numbers(self):
+        try:
+            write_json(self.channel_map_path, self.channel_numbers)
+        except Exception as e:
+            print(f"[ERROR] Unable to save channel map {self.channel_map_path}: {e}")
 
     #########################################################################################
     # EPG Guide Data
     #########################################################################################
-    def strip_illegal_characters(self, xml_string):
-        # Define a regular expression pattern to match illegal characters
-        illegal_char_pattern = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
-
-        # Replace illegal characters with an empty string
-        clean_xml_string = illegal_char_pattern.sub('', xml_string)
-
-        return clean_xml_string
-
-
     def update_epg(self, country_code, range_count = 3):
         resp, error = self.resp_data(country_code)
         if error: return None, error
@@ -241,12 +811,14 @@ class Client:
         if token is None: return None, error
 
         desired_timezone = pytz.timezone('UTC')
+        time_format = "%Y-%m-%dT%H:%M:%S.000Z"
 
-        start_datetime = datetime.now(desired_timezone)
-        start_time = start_datetime.strftime("%Y-%m-%dT%H:00:00.000Z")
-        end_time = start_time
+        # Window boundaries are precomputed so the windows can be fetched independently
+        start_datetime = datetime.now(desired_timezone).replace(minute=0, second=0, microsecond=0)
+        window = timedelta(minutes=720)
+        horizon_end = start_datetime + range_count * window
 
-        url = f"https://service-channels.clusters.pluto.tv/v2/guide/timelines"
+        url = f"{self.service_url}/v2/guide/timelines"
 
         epg_headers = {
             'authority': 'service-channels.clusters.pluto.tv',
@@ -258,7 +830,7 @@ class Client:
             }
 
         epg_params = {
-            'start': start_time,
+            'start': '',
             'channelIds': '',
             'duration': '720',
             }
@@ -270,33 +842,89 @@ class Client:
         if error: return None, error
 
         id_values = [d['id'] for d in station_list]
-        group_size = 100
-        grouped_id_values = [id_values[i:i + group_size] for i in range(0, len(id_values), group_size)]
-        # country_data = self.epg_data.get(country_code, [])
-        country_data = []
-
-        for i in range(range_count):
-            if end_time != start_time:
-                start_time = end_time
-                epg_params.update({'start': start_time})
-            print(f'Retrieving {country_code} EPG data for {start_time}')
-
-            for group in grouped_id_values:
-                epg_params.update({"channelIds": ','.join(map(str, group))})
-                try:
-                    response = self.session.get(url, params=epg_params, headers=epg_headers)
-                except Exception as e:
-                    return None, (f"Error Exception type: {type(e).__name__}")
-                
-                if response.status_code != 200:
-                    return None, f"HTTP failure {response.status_code}: {response.text}"
-                country_data.append(response.json())
-
-
-            end_time = datetime.strptime(response.json()["meta"]["endDateTime"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:00:00.000Z")
 
+        # Work out which (window start, channels, replace) requests are needed
+        store = self.timeline_stores.get(country_code) if self.epg_incremental else None
+        windows = []
+        if store is None or store.horizon is None or store.horizon <= start_datetime:
+            store = TimelineStore()
+            windows = [(start_datetime + i * window, id_values, False) for i in range(range_count)]
+            horizon, validated = horizon_end, start_datetime
+        else:
+            store.expire(start_datetime.strftime(time_format), id_values)
+            horizon, validated = store.horizon, store.validated
+            known_ids = [i for i in id_values if i in store.channel_ids]
+            new_ids = [i for i in id_values if i not in store.channel_ids]
+
+            # Channels that joined the lineup need everything up to the current horizon
+            tail = start_datetime
+            while new_ids and tail < store.horizon:
+                windows.append((tail, new_ids, False))
+                tail += window
+
+            # Only the newly exposed tail is fetched for channels already held
+            tail = store.horizon
+            while tail < horizon_end:
+                windows.append((tail, id_values, False))
+                tail += window
+            horizon = max(horizon, tail)
+
+            # Optionally re-fetch the current window more often than the far future
+            if known_ids and self.epg_revalidate and start_datetime - validated >= self.epg_revalidate:
+                windows.append((start_datetime, known_ids, True))
+                validated = start_datetime
 
-        self.epg_data.update({country_code: country_data})
+        group_size = 100
+        jobs = []
+        for window_start, ids, replace in windows:
+            start_time = window_start.strftime(time_format)
+            print(f'Retrieving {country_code} EPG data for {start_time}')
+            for i in range(0, len(ids), group_size):
+                jobs.append((start_time, ids[i:i + group_size], replace))
+
+        def fetch_timeline(job):
+            start_time, group, replace = job
+            channel_ids = ','.join(map(str, group))
+            cache_key = f"{country_code}/{start_time}/{hashlib.sha1(channel_ids.encode()).hexdigest()}"
+            # A window being re-validated always goes upstream
+            if self.cache and not replace:
+                page, _ = self.cache.get('timelines', cache_key)
+                if page is not None:
+                    return ingest_page(page), None
+
+            params = dict(epg_params, start=start_time, channelIds=channel_ids)
+            try:
+                response = self.upstream_get('timelines', country_code, url, params=params, headers=epg_headers)
+            except Exception as e:
+                return None, (f"Error Exception type: {type(e).__name__}")
+
+            if response.status_code != 200:
+                return None, f"HTTP failure {response.status_code}: {response.text}"
+            page = response.json()
+            if self.cache:
+                self.cache.set('timelines', cache_key, page)
+            return ingest_page(page), None
+
+        # Fan out every window x group request, imap hands the results back in request order
+        results = []
+        pool = Pool(self.epg_concurrency)
+        for data, error in pool.imap(fetch_timeline, jobs):
+            if error:
+                pool.kill()
+                return None, error
+            results.append(data)
+
+        # Everything arrived, fold it into the store in request order
+        for (start_time, group, replace), data in zip(jobs, results):
+            if replace:
+                stop_time = (datetime.strptime(start_time, time_format) + window).strftime(time_format)
+                store.discard_range(group, start_time, stop_time)
+            store.add(start_time, data)
+        store.horizon, store.validated = horizon, validated
+
+        if self.epg_incremental:
+            self.timeline_stores.update({country_code: store})
+        self.epg_data.update({country_code: store.pages(id_values)})
         return None
 
     def epg_json(self, country_code):
@@ -304,260 +932,175 @@ class Client:
         if error_code:
             print("error")
             return None, error_code
-        return self.epg_data, None
-
-    def find_tuples_by_value(self, dictionary, target_value):
-        result_list = []  # Initialize an empty list
-        for key, values in dictionary.items():
-            if target_value in values:
-                result_list.extend(key)  # Add the first element of the tuple to the result list
-        return result_list if result_list else [target_value]  # Return None if the value is not found in any list
-
-    def read_epg_data(self, resp, root):
-        seriesGenres = {
-            ("Animated",): ["Family Animation", "Cartoons"],
-            ("Educational",): ["Education & Guidance", "Instructional & Educational"],
-            ("News",): ["News and Information", "General News", "News + Opinion", "General News"],
-            ("History",): ["History & Social Studies"],
-            ("Politics",): ["Politics"],
-            ("Action",):
-                [
-                  "Action & Adventure",
-                  "Action Classics",
-                  "Martial Arts",
-                  "Crime Action",
-                  "Family Adventures",
-                  "Action Sci-Fi & Fantasy",
-                  "Action Thrillers",
-                  "African-American Action",
-                ],
-            ("Adventure",): ["Action & Adventure", "Adventures", "Sci-Fi Adventure"],
-            ("Reality",):
-                [
-                  "Reality",
-                  "Reality Drama",
-                  "Courtroom Reality",
-                  "Occupational Reality",
-                  "Celebrity Reality",
-                ],
-            ("Documentary",):
-                [
-                  "Documentaries",
-                  "Social & Cultural Documentaries",
-                  "Science and Nature Documentaries",
-                  "Miscellaneous Documentaries",
-                  "Crime Documentaries",
-                  "Travel & Adventure Documentaries",
-                  "Sports Documentaries",
-                  "Military Documentaries",
-                  "Political Documentaries",
-                  "Foreign Documentaries",
-                  "Religion & Mythology Documentaries",
-                  "Historical Documentaries",
-                  "Biographical Documentaries",
-                  "Faith & Spirituality Documentaries",
-                ],
-            ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
-            ("Science Fiction",): ["Sci-Fi Thrillers", "Sci-Fi Adventure", "Action Sci-Fi & Fantasy"],
-            ("Thriller",): ["Sci-Fi Thrillers", "Thrillers", "Crime Thrillers"],
-            ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
-            ("Talk",): ["Talk & Variety", "Talk Show"],
-            ("Variety",): ["Sketch Comedies"],
-            ("Home Improvement",): ["Art & Design", "DIY & How To", "Home Improvement"],
-            ("House/garden",): ["Home & Garden"],
-            # ("Science",): ["Science and Nature Documentaries"],
-            # ("Nature",): ["Science and Nature Documentaries", "Animals"],
-            ("Cooking",): ["Cooking Instruction", "Food & Wine", "Food Stories"],
-            ("Travel",): ["Travel & Adventure Documentaries", "Travel"],
-            ("Western",): ["Westerns", "Classic Westerns"],
-            ("LGBTQ",): ["Gay & Lesbian", "Gay & Lesbian Dramas", "Gay"],
-            ("Game show",): ["Game Show"],
-            ("Military",): ["Classic War Stories"],
-            ("Comedy",):
-                [
-                  "Cult Comedies",
-                  "Spoofs and Satire",
-                  "Slapstick",
-                  "Classic Comedies",
-                  "Stand-Up",
-                  "Sports Comedies",
-                  "African-American Comedies",
-                  "Showbiz Comedies",
-                  "Sketch Comedies",
-                  "Teen Comedies",
-                  "Latino Comedies",
-                  "Family Comedies",
-                ],
-            ("Crime",): ["Crime Action", "Crime Drama", "Crime Documentaries"],
-            ("Sports",): ["Sports","Sports & Sports Highlights","Sports Documentaries", "Poker & Gambling"],
-            ("Poker & Gambling",): ["Poker & Gambling"],
-            ("Crime drama",): ["Crime Drama"],
-            ("Drama",):
-                [
-                  "Classic Dramas",
-                  "Family Drama",
-                  "Indie Drama",
-                  "Romantic Drama",
-                  "Crime Drama",
-                ],
-            ("Children",): ["Kids", "Children & Family", "Kids' TV", "Cartoons", "Animals", "Family Animation", "Ages 2-4", "Ages 11-12",],
-            ("Animated",): ["Family Animation", "Cartoons"]
-            }
-
-        for entry in resp["data"]:
-            for timeline in entry["timelines"]:
-                # Create programme element
-                programme = ET.SubElement(root, "programme", attrib={"channel": entry["channelId"],
-                                                                 "start": datetime.strptime(timeline["start"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z"),
-                                                                 "stop": datetime.strptime(timeline["stop"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")})
-                # Add sub-elements to programme
-                title = ET.SubElement(programme, "title")
-                title.text = self.strip_illegal_characters(timeline["title"])
-                if timeline["episode"].get("series", {}).get("type", "") == "live":
-                    if timeline["episode"]["clip"]["originalReleaseDate"] == timeline["start"]:
-                        live = ET.SubElement(programme, "live")
-                    if timeline["episode"].get("season", None):
-                        episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
-                        episode_num_onscreen.text = f'S{timeline["episode"]["season"]:02d}E{timeline["episode"]["number"]:02d}'
-                        episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
-                        episode_num_pluto.text = timeline["episode"]["_id"]
-                elif timeline["episode"].get("series", {}).get("type", "") == "tv":
-                    episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
-                    episode_num_onscreen.text = f'S{timeline["episode"]["season"]:02d}E{timeline["episode"]["number"]:02d}'
-                    episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
-                    episode_num_pluto.text = timeline["episode"]["_id"]
-                episode_num_air_date = ET.SubElement(programme, "episode-num", attrib={"system": "original-air-date"})
-                episode_num_air_date.text = datetime.strptime(timeline["episode"]["clip"]["originalReleaseDate"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
-                desc = ET.SubElement(programme, "desc")
-                desc.text = self.strip_illegal_characters(timeline["episode"]["description"]).replace('&quot;', '"')
-                icon_programme = ET.SubElement(programme, "icon", attrib={"src": timeline["episode"]["series"]["tile"]["path"]})
-                date = ET.SubElement(programme, "date")
-                date.text = datetime.strptime(timeline["episode"]["clip"]["originalReleaseDate"], "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y%m%d")
-                # if timeline["episode"].get("series", {}).get("type", "") == "tv":
-                series_id_pluto = ET.SubElement(programme, "series-id", attrib={"system": "pluto"})
-                series_id_pluto.text = timeline["episode"]["series"]["_id"]
-                if timeline["title"].lower() != timeline["episode"]["name"].lower():
-                    sub_title = ET.SubElement(programme, "sub-title")
-                    sub_title.text = self.strip_illegal_characters(timeline["episode"]["name"])
-                categories = []
-                if timeline["episode"].get("genre", None) is not None:
-                    genre = timeline["episode"]["genre"]
-                    result = self.find_tuples_by_value(seriesGenres, genre)
-                    categories.extend(result)
-                if timeline["episode"].get("series", {}).get("type", "") == "tv":
-                    categories.append("Series")
-                if timeline["episode"].get("series", {}).get("type", "") == "film":
-                    categories.append("Movie")
-                if timeline["episode"].get("subGenre", None) is not None:
-                    subGenre = timeline["episode"]["subGenre"]
-                    result = self.find_tuples_by_value(seriesGenres, subGenre)
-                    categories.extend(result)
-                # categories = sorted(categories)
-
-                unique_list = []
-                for item in categories:
-                    if item not in unique_list:
-                        unique_list.append(item)
-
-                for category in unique_list:
-                    category_elem = ET.SubElement(programme, "category")
-                    category_elem.text = category
-        return root
-
-    def get_all_epg_data(self, country_code):
-        all_epg_data = []
-        # print (country_code)
-        channelIds_seen = {}
-        range_count = 3
+        # Programme records are not JSON, hand out the upstream layout for the country asked for
+        return {country_code: [page_json(page) for page in self.epg_data.get(country_code, [])]}, None
 
+    def get_all_epg_data(self, country_code, fetch=True, station_list=None):
         for country in country_code:
-            error_code = self.update_epg(country, range_count)
-            if error_code: return error_code
+            if fetch or country not in self.epg_data:
+                error_code = self.update_epg(country)
+                if error_code: return error_code
+
+        if station_list is None:
+            station_list, error = self.channels_all()
+            if error: return None, error
 
+        # Each channel's programmes come from the country channels_all took the
+        # channel from. A channel whose owner has no guide here falls back to the
+        # first country that carries it.
+        channel_owner = {station['id']: station['country_code'] for station in station_list}
+        available = set(country_code)
+        for channel_id, owner in list(channel_owner.items()):
+            if owner not in available:
+                del channel_owner[channel_id]
+
+        # One pass over every page, keeping the owner's entries and skipping any
+        # (channelId, start) already taken
+        all_epg_data = []
+        seen = set()
+        for country in country_code:
             for epg_list in self.epg_data.get(country):
-                data_list = epg_list.get('data')
-                # Make a copy of the list for iteration to avoid modifying the list while iterating
-                for entry in data_list[:]:
+                # Build a filtered copy so the per-country pages stay intact for reuse
+                data_list = []
+                for entry in epg_list.get('data'):
                     channelId = entry.get('channelId')
-                    if channelId in channelIds_seen:
-                        if channelIds_seen.get(channelId, 0) < range_count:
-                            channelIds_seen.update({channelId: (channelIds_seen.get(channelId, 0) + 1)})
-                            # print(f"[INFO] Adding {country}: {channelId}")
-                        else:
-                            # print(f"[INFO] Beyond {range_count}: Skipping duplicate entry for {country}: {channelId}")
-                            data_list.remove(entry)
-                    else:
-                        channelIds_seen.update({channelId: 1})
-                epg_data_dict = {'data': data_list}
-                all_epg_data.append(epg_data_dict)
+                    if channel_owner.setdefault(channelId, country) != country:
+                        continue
+                    timelines = []
+                    for timeline in entry.get('timelines'):
+                        key = (channelId, timeline.start)
+                        if key not in seen:
+                            seen.add(key)
+                            timelines.append(timeline)
+                    data_list.append({'channelId': channelId, 'timelines': timelines})
+                all_epg_data.append({'data': data_list})
 
-            
-        # print(f"[INFO] Length {len(all_epg_data)}")
         return(all_epg_data)
 
+    def refresh_country(self, country_code):
+        # The fetched pages stay in epg_data for the next epg-all build
+        with metrics.EPG_PHASE.time(file=f"epg-{country_code}.xml", phase='fetch'):
+            error_code = self.update_epg(country_code)
+        if error_code: return error_code
+        return self.create_xml_file(country_code, fetch=False)
+
+    def refresh_all_file(self, country_list):
+        # Build epg-all from the countries whose guide has been fetched
+        errors = []
+        fetched = [country for country in country_list if country in self.epg_data]
+        if fetched:
+            error_code = self.create_xml_file(fetched, fetch=False)
+            if error_code: errors.append(error_code)
+
+        if self.cache:
+            self.cache.purge()
+        return errors
+
+    def render(self, xml_file_path, *args):
+        if not self.render_workers:
+            return render_guide(xml_file_path, *args)
+        if self.fragment_cache:
+            # The fragments stay in the worker that rendered the file, so each
+            # file always goes to the same single-process executor
+            slot = self.render_slots.setdefault(xml_file_path, len(self.render_slots) % self.render_workers)
+            size = 1
+        else:
+            slot, size = 0, self.render_workers
+        executor = self.render_executors.get(slot)
+        if executor is None:
+            # spawn keeps the gevent hub and open sockets out of the workers, and
+            # main.py keeps them from re-running pywsgi.py as their __main__
+            executor = ProcessPoolExecutor(size, mp_context=multiprocessing.get_context('spawn'))
+            self.render_executors[slot] = executor
+        try:
+            return executor.submit(render_guide, xml_file_path, *args).result()
+        except BrokenProcessPool:
+            # A worker died and its fragments with it, start a fresh one for the next file
+            del self.render_executors[slot]
+            raise
+
+    def publish_generation(self, xml_file_path, generation):
+        published = datetime.now(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.epg_generation[xml_file_path] = {'generation': generation, 'published': published}
+        try:
+            write_json(self.generation_path, self.epg_generation)
+        except Exception as e:
+            print(f"[ERROR] Unable to save {self.generation_path}: {e}")
+        print(f"[INFO] Published {xml_file_path} generation {generation}")
 
-    def create_xml_file(self, country_code):
+    def create_xml_file(self, country_code, fetch=True):
         if isinstance(country_code, str):
-            error_code = self.update_epg(country_code)
-            if error_code: return error_code
+            if fetch:
+                with metrics.EPG_PHASE.time(file=f"epg-{country_code}.xml", phase='fetch'):
+                    error_code = self.update_epg(country_code)
+                if error_code: return error_code
 
-            station_list, error = self.channels(country_code)
-            if error: return None, error
+            # update_epg has just refreshed the lineup, reuse it unless fetching here
+            station_list = None if fetch else self.all_channels.get(country_code)
+            if station_list is None:
+                station_list, error = self.channels(country_code)
+                if error: return None, error
 
             xml_file_path = f"epg-{country_code}.xml"
 
         elif isinstance(country_code, list):
+            # Fetch first so channel ownership comes from the refreshed lineups
+            if fetch:
+                with metrics.EPG_PHASE.time(file="epg-all.xml", phase='fetch'):
+                    for country in country_code:
+                        error_code = self.update_epg(country)
+                        if error_code: return error_code
+
             xml_file_path = f"epg-all.xml"
             station_list, error = self.channels_all()
+            if error: return None, error
         else:
             print("The variable is neither a string nor a list.")
             return None
 
         compressed_file_path = f"{xml_file_path}.gz"
-        root = ET.Element("tv", attrib={"generator-info-name": "jgomez177", "generated-ts": ""})
-
-        # Create Channel Elements from list of Stations
-        for station in station_list:
-            channel = ET.SubElement(root, "channel", attrib={"id": station["id"]})
-            display_name = ET.SubElement(channel, "display-name")
-            display_name.text = self.strip_illegal_characters(station["name"])
-            icon = ET.SubElement(channel, "icon", attrib={"src": station["logo"]})
 
-        # Create Programme Elements
+        # Collect the programme pages before any file is opened for writing
+        collecting = time.perf_counter()
         if isinstance(country_code, str):
             program_data =  self.epg_data.get(country_code, [])
         else:
             # Write program_data for all countries
-            program_data = self.get_all_epg_data(country_code)
-            #print(len(program_data))
-            #for elem in program_data:
-            #    print(len(elem.get("data")))
-            #program_data = []
-        # print(f"Program data: {len(program_data)}")
-        for elem in program_data:
-            root = self.read_epg_data(elem, root)
-
-
-        # Create an ElementTree object
-        tree = ET.ElementTree(root)
-        ET.indent(tree, '  ')
-
-        # Create a DOCTYPE declaration
-        doctype = '<!DOCTYPE tv SYSTEM "xmltv.dtd">'
-
-        # Concatenate the XML and DOCTYPE declarations in the desired order
-        xml_declaration = '<?xml version=\'1.0\' encoding=\'utf-8\'?>'
-        output_content = xml_declaration + '\n' + doctype + '\n' + ET.tostring(root, encoding='utf-8').decode('utf-8')
-
-        # Write the concatenated content to the output file
-        with open(xml_file_path, "w", encoding='utf-8') as f:
-            f.write(output_content)
-
-        # Compress the XML file
-        with open(xml_file_path, 'rb') as file:
-            with gzip.open(compressed_file_path, 'wb') as compressed_file:
-                compressed_file.writelines(file)
-
-        # Clear the EPG data after writing full XML File
-        self.epg_data = {}
+            program_data = self.get_all_epg_data(country_code, False, station_list)
+            if isinstance(program_data, tuple): return program_data
+        collected = time.perf_counter()
+
+        # Stream the guide into staging files, they replace the published ones once complete
+        generation = self.epg_generation.get(xml_file_path, {}).get('generation', 0) + 1
+        # Workers only need the fields written to <channel>
+        stations = [{'id': station['id'], 'name': station['name'], 'logo': station['logo']} for station in station_list]
+        try:
+            result = self.render(os.path.abspath(xml_file_path), os.path.abspath(compressed_file_path),
+                                 stations, program_data, self.genre_map, generation, self.gzip_level, self.gzip_threads,
+                                 self.fragment_cache)
+        except Exception as e:
+            return None, f"Rendering {xml_file_path} failed: {type(e).__name__}: {e}"
+        if result['fragments'] is not None:
+            metrics.EPG_FRAGMENTS.inc(result['fragments']['cached'], file=xml_file_path, result='cached')
+            metrics.EPG_FRAGMENTS.inc(result['fragments']['rendered'], file=xml_file_path, result='rendered')
+            metrics.EPG_FRAGMENT_CACHE_ENTRIES.set(result['fragments']['entries'], file=xml_file_path)
+
+        metrics.EPG_PHASE.observe(collected - collecting, file=xml_file_path, phase='collect')
+        for phase, seconds in result['timings'].items():
+            metrics.EPG_PHASE.observe(seconds, file=xml_file_path, phase=phase)
+        sizes = {path: os.path.getsize(path) for path in (xml_file_path, compressed_file_path)}
+        for path, size in sizes.items():
+            metrics.EPG_ARTIFACT_BYTES.set(size, file=path)
+        if sizes[compressed_file_path]:
+            metrics.EPG_GZIP_RATIO.set(round(sizes[xml_file_path] / sizes[compressed_file_path], 3), file=compressed_file_path)
+        if result['timings']['gzip']:
+            metrics.EPG_GZIP_THROUGHPUT.set(round(sizes[xml_file_path] / result['timings']['gzip']), file=compressed_file_path)
+        metrics.EPG_CHANNELS.set(len(station_list), file=xml_file_path)
+        metrics.EPG_PROGRAMMES.set(result['element_count'] - len(station_list), file=xml_file_path)
+
+        self.publish_generation(xml_file_path, generation)
+
+        # Clear the EPG data after writing full XML File, scheduled refreshes keep it for epg-all
+        if fetch:
+            self.epg_data = {}
         return None
\ No newline at end of file
@@ -1,14 +1,28 @@
+import os, sys
+
+# Render workers are spawned processes that re-run the __main__ module. Run as
+# a script this module would patch gevent, open the cache and build the app in
+# every one of them, so hand over to main.py before doing anything.
+if __name__ == '__main__':
+    os.execv(sys.executable, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'), *sys.argv[1:]])
+
 from gevent.pywsgi import WSGIServer
-from flask import Flask, redirect, request, Response, send_file
-from threading import Thread
-import os, sys, importlib, schedule, time, re, uuid, unicodedata
-from urllib.parse import urlparse, urlencode, urlunparse, parse_qs
+from flask import Flask, redirect, request, Response, send_file, g
+import importlib, time, re, uuid, hashlib, hmac, json
+from urllib.parse import urlencode, urljoin
 from datetime import datetime, timedelta
 
 # import flask module
 from gevent import monkey
 monkey.patch_all()
 
+# requests, ssl and threading have to be imported after patching, an
+# unpatched Lock blocks the whole hub when two greenlets contend for it
+from threading import Thread, Lock
+import metrics
+from transport import session_stats
+from scheduler import Scheduler
+
 
 version = "1.22"
 updated_date = "Sept. 20, 2025"
@@ -24,6 +38,98 @@ except:
 pluto_username = os.environ.get("PLUTO_USERNAME")
 pluto_password = os.environ.get("PLUTO_PASSWORD")
 
+# Number of concurrent EPG timeline requests per country
+try:
+    epg_concurrency = int(os.environ.get("PLUTO_EPG_CONCURRENCY", 4))
+except:
+    epg_concurrency = 4
+
+# Seconds a rendered playlist is served before it is refreshed in the background
+try:
+    playlist_ttl = int(os.environ.get("PLUTO_PLAYLIST_TTL", 600))
+except:
+    playlist_ttl = 600
+
+# Optional JSON file overriding the genre to XMLTV category mapping
+genre_map_path = os.environ.get("PLUTO_GENRE_MAP")
+
+# Optional JSON file used to keep channel numbers stable across refreshes and restarts
+channel_map_path = os.environ.get("PLUTO_CHANNEL_MAP")
+
+# Incremental EPG refresh keeps the guide between runs and only fetches the new tail window
+epg_incremental = os.environ.get("PLUTO_EPG_INCREMENTAL", "false").lower() in ("1", "true", "yes")
+try:
+    epg_revalidate_hours = float(os.environ.get("PLUTO_EPG_REVALIDATE_HOURS", 6))
+except:
+    epg_revalidate_hours = 6
+
+# Keep rendered programmes between refreshes and only build the new or changed ones
+epg_fragment_cache = os.environ.get("PLUTO_EPG_FRAGMENT_CACHE", "true").lower() in ("1", "true", "yes")
+
+# Log one JSON line per tune when enabled
+access_log = os.environ.get("PLUTO_ACCESS_LOG", "false").lower() in ("1", "true", "yes")
+
+# SQLite file caching upstream responses across restarts, set empty to disable
+cache_path = os.environ.get("PLUTO_CACHE_PATH", "pluto-cache.db")
+
+# Upstream connection pool size (0 sizes it from PLUTO_EPG_CONCURRENCY), timeouts in seconds and retries
+try:
+    http_pool_size = int(os.environ.get("PLUTO_HTTP_POOL_SIZE", 0))
+except:
+    http_pool_size = 0
+try:
+    http_connect_timeout = float(os.environ.get("PLUTO_HTTP_CONNECT_TIMEOUT", 5))
+except:
+    http_connect_timeout = 5
+try:
+    http_read_timeout = float(os.environ.get("PLUTO_HTTP_READ_TIMEOUT", 30))
+except:
+    http_read_timeout = 30
+try:
+    http_retries = int(os.environ.get("PLUTO_HTTP_RETRIES", 3))
+except:
+    http_retries = 3
+
+# Worker processes rendering the guide files, 0 renders them inside the server process
+try:
+    render_workers = int(os.environ.get("PLUTO_RENDER_WORKERS", min(4, os.cpu_count() or 1)))
+except:
+    render_workers = min(4, os.cpu_count() or 1)
+
+# Compression level of the .xml.gz files, 1 is fastest and 9 smallest
+try:
+    gzip_level = max(1, min(9, int(os.environ.get("PLUTO_GZIP_LEVEL", 9))))
+except:
+    gzip_level = 9
+
+# Threads compressing each .xml.gz inside a render worker
+try:
+    gzip_threads = int(os.environ.get("PLUTO_GZIP_THREADS", min(4, os.cpu_count() or 1)))
+except:
+    gzip_threads = min(4, os.cpu_count() or 1)
+
+# Serve the stitcher's master playlist from here instead of redirecting to it
+stitcher_proxy = os.environ.get("PLUTO_STITCHER_PROXY", "false").lower() in ("1", "true", "yes")
+try:
+    stitcher_ttl = float(os.environ.get("PLUTO_STITCHER_TTL", 20))
+except:
+    stitcher_ttl = 20
+
+# Minutes between EPG refreshes of each country
+try:
+    epg_interval = float(os.environ.get("PLUTO_EPG_INTERVAL_MINUTES", 120)) * 60
+except:
+    epg_interval = 120 * 60
+
+# Seconds between the first refreshes of consecutive countries, spreads the upstream load
+try:
+    epg_stagger = float(os.environ.get("PLUTO_EPG_STAGGER", 30))
+except:
+    epg_stagger = 30
+
+# Token required by the on-demand refresh endpoint, the endpoint is disabled without it
+admin_token = os.environ.get("PLUTO_ADMIN_TOKEN")
+
 pluto_country_list = os.environ.get("PLUTO_CODE")
 if pluto_country_list:
    pluto_country_list = pluto_country_list.split(',')
@@ -35,11 +141,230 @@ ALLOWED_COUNTRY_CODES = ['local', 'us_east', 'us_west', 'ca', 'uk', 'fr', 'de',
 app = Flask(__name__)
 provider = "pluto"
 providers = {
-    provider: importlib.import_module(provider).Client(pluto_username, pluto_password),
+    provider: importlib.import_module(provider).Client(pluto_username, pluto_password, epg_concurrency, genre_map_path, channel_map_path,
+                                                       epg_incremental=epg_incremental, epg_revalidate_hours=epg_revalidate_hours,
+                                                       cache_path=cache_path, pool_size=http_pool_size,
+                                                       connect_timeout=http_connect_timeout, read_timeout=http_read_timeout,
+                                                       retries=http_retries, render_workers=render_workers,
+                                                       gzip_level=gzip_level, gzip_threads=gzip_threads,
+                                                       fragment_cache=epg_fragment_cache),
+
+}
+
+def render_playlist(stations, provider, country_code, channel_id_format, host):
+    stations = sorted(stations, key = lambda i: i.get('number', 0))
+
+    m3u = ["#EXTM3U\r\n\r\n"]
+    for s in stations:
+        url = f"http://{host}/{provider}/{country_code}/watch/{s.get('watchId') or s.get('id')}\n\n"
+
+        if channel_id_format == 'id':
+            m3u.append(f"#EXTINF:-1 channel-id=\"{provider}-{s.get('id')}\"")
+        elif channel_id_format == 'slug_only':
+            m3u.append(f"#EXTINF:-1 channel-id=\"{s.get('slug')}\"")
+        else:
+            m3u.append(f"#EXTINF:-1 channel-id=\"{provider}-{s.get('slug')}\"")
+        m3u.append(f" tvg-id=\"{s.get('id')}\"")
+        if s.get('number'): m3u.append(f" tvg-chno=\"{''.join(map(str, str(s.get('number', []))))}\"")
+        if s.get('group'): m3u.append(f" group-title=\"{''.join(map(str, s.get('group', [])))}\"")
+        if s.get('logo'): m3u.append(f" tvg-logo=\"{''.join(map(str, s.get('logo', [])))}\"")
+        if s.get('tmsid'): m3u.append(f" tvg-name=\"{''.join(map(str, s.get('tmsid', [])))}\"")
+        if s.get('name'): m3u.append(f" tvc-guide-title=\"{''.join(map(str, s.get('name', [])))}\"")
+        # Summaries were stripped of control characters when the lineup was built
+        if s.get('summary'): m3u.append(f" tvc-guide-description=\"{''.join(map(str, s.get('summary', [])))}\"")
+        if s.get('timeShift'): m3u.append(f" tvg-shift=\"{''.join(map(str, s.get('timeShift', [])))}\"")
+        m3u.append(f",{s.get('name') or s.get('call_sign')}\n")
+        m3u.append(f"{url}\n")
+    return ''.join(m3u)
+
+class PlaylistCache:
+    # Playlists are rendered once per lineup refresh for every channel_id_format
+    # and served from memory. An entry older than ttl keeps being served while
+    # a background refresh replaces it (stale-while-revalidate).
+    FORMATS = ('', 'id', 'slug_only')
+    HOST_MARKER = '\x00host\x00'
+    CHUNK_SIZE = 64 * 1024
+    MAX_HOSTS = 16
+
+    def __init__(self, client, provider, country_list, ttl):
+        self.client = client
+        self.provider = provider
+        self.country_list = country_list
+        self.ttl = ttl
+        self.entries = {}
+        self.locks = {}
+
+    def lock(self, country_code):
+        return self.locks.setdefault(country_code, Lock())
+
+    def is_stale(self, entry):
+        return (time.monotonic() - entry['created']) > self.ttl
+
+    def refresh(self, country_code, fetch=True):
+        if country_code == 'all':
+            if fetch:
+                for code in self.country_list:
+                    _, error = self.client.channels(code)
+                    if error: print(f"[ERROR] Playlist refresh for {code}: {error}")
+            stations, error = self.client.channels_all()
+        elif fetch:
+            stations, error = self.client.channels(country_code)
+        else:
+            stations, error = self.client.all_channels.get(country_code), None
+        if error: return error
+        if not stations: return None
+
+        # Render with a marker in place of the host, the request host is filled in per client
+        templates = {fmt: render_playlist(stations, self.provider, country_code, fmt, self.HOST_MARKER).split(self.HOST_MARKER)
+                     for fmt in self.FORMATS}
+        self.entries[country_code] = {'templates': templates, 'rendered': {}, 'created': time.monotonic()}
+        return None
+
+    def rebuild(self):
+        # Re-render every lineup from the channels the client already holds
+        for code in [*self.client.all_channels.keys(), 'all']:
+            error = self.refresh(code, fetch=False)
+            if error: print(f"[ERROR] Playlist rebuild for {code}: {error}")
+
+    def revalidate(self, country_code):
+        lock = self.lock(country_code)
+        if lock.locked():
+            return
+
+        def run():
+            with lock:
+                entry = self.entries.get(country_code)
+                if entry is not None and not self.is_stale(entry):
+                    return
+                error = self.refresh(country_code)
+                if error: print(f"[ERROR] Playlist refresh for {country_code}: {error}")
+
+        Thread(target=run, daemon=True).start()
+
+    def get(self, country_code, channel_id_format, host):
+        entry = self.entries.get(country_code)
+        if entry is None:
+            with self.lock(country_code):
+                entry = self.entries.get(country_code)
+                if entry is None:
+                    error = self.refresh(country_code)
+                    if error: return None, error
+                    entry = self.entries.get(country_code)
+                    if entry is None: return None, f"No channels available for {country_code}"
+        elif self.is_stale(entry):
+            self.revalidate(country_code)
+
+        fmt = channel_id_format if channel_id_format in self.FORMATS else ''
+        rendered = entry['rendered'].get((fmt, host))
+        if rendered is None:
+            if len(entry['rendered']) >= self.MAX_HOSTS * len(self.FORMATS):
+                entry['rendered'].clear()
+            body = host.join(entry['templates'][fmt]).encode('utf-8')
+            rendered = (body, hashlib.sha1(body).hexdigest())
+            entry['rendered'][(fmt, host)] = rendered
+        return rendered, None
+
+STITCHER = "https://cfd-v4-service-channel-stitcher-use1-1.prd.pluto.tv"
+JWT_REQUIRED_CHANNELS = frozenset(['625f054c5dfea70007244612', '625f04253e5f6c000708f3b7', '5421f71da6af422839419cb3'])
+
+# Per-channel stitcher URL split around the sid value, filled on first tune
+stitcher_templates = {}
+
+def stitcher_template(id, client_id):
+    params = {'advertisingId': '',
+              'appName': 'web',
+              'appVersion': 'unknown',
+              'appStoreUrl': '',
+              'architecture': '',
+              'buildVersion': '',
+              'clientTime': '0',
+              'deviceDNT': '0',
+              'deviceId': client_id,
+              'deviceMake': 'Chrome',
+              'deviceModel': 'web',
+              'deviceType': 'web',
+              'deviceVersion': 'unknown',
+              'includeExtendedEvents': 'false',
+              'sid': '',
+              'userId': '',
+              'serverSideAds': 'true'
+    }
+    query = urlencode(params)
+    prefix, suffix = query.split('&sid=&')
+    return (f"{STITCHER}/stitch/hls/channel/{id}/master.m3u8?{prefix}&sid=", f"&{suffix}")
+
+URI_ATTRIBUTE = re.compile(r'URI="([^"]*)"')
+
+def rewrite_master_playlist(text, base_url):
+    # Variant and media URIs are usually relative to the stitcher, make them
+    # absolute so players fetch them from Pluto rather than from us
+    lines = []
+    for line in text.splitlines():
+        if line.startswith('#'):
+            line = URI_ATTRIBUTE.sub(lambda m: f'URI="{urljoin(base_url, m.group(1))}"', line)
+        elif line.strip():
+            line = urljoin(base_url, line.strip())
+        lines.append(line)
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+class MasterPlaylistCache:
+    # Master playlists fetched from the stitcher, kept for ttl seconds per
+    # country and channel. Concurrent tunes of a channel wait for the one
+    # request in flight instead of each going upstream.
+    MAX_ENTRIES = 4096
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+        self.entries = {}
+        self.locks = {}
+
+    def lock(self, key):
+        return self.locks.setdefault(key, Lock())
+
+    def fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def get(self, country_code, id, video_url):
+        key = (country_code, id)
+        body = self.fresh(key)
+        if body is not None:
+            return body, None
+
+        lock = self.lock(key)
+        try:
+            with lock:
+                body = self.fresh(key)
+                if body is not None:
+                    return body, None
+                try:
+                    response = self.client.upstream_get('stitcher', country_code, video_url)
+                except Exception as e:
+                    return None, f"Error Exception type: {type(e).__name__}"
+                if response.status_code != 200:
+                    return None, f"HTTP failure {response.status_code}"
+
+                body = rewrite_master_playlist(response.text, response.url)
+                if len(self.entries) >= self.MAX_ENTRIES:
+                    self.entries.clear()
+                self.entries[key] = (body, time.monotonic())
+                return body, None
+        finally:
+            # A lock is only needed while a fetch is in flight, tunes waiting
+            # on it already hold it and later ones find the cached entry
+            if self.locks.get(key) is lock:
+                del self.locks[key]
+
+playlists = {
+    provider: PlaylistCache(providers[provider], provider, pluto_country_list, playlist_ttl),
 }
 
-def remove_non_printable(s):
-    return ''.join([char for char in s if not unicodedata.category(char).startswith('C')])
+master_playlists = {
+    provider: MasterPlaylistCache(providers[provider], stitcher_ttl),
+}
 
 url = f'<!DOCTYPE html>\
         <html>\
@@ -119,6 +444,19 @@ url = f'<!DOCTYPE html>\
                 Last Updated: {updated_date}\
               '
 
+# Per-route latency for /metrics
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    started = g.get('started')
+    if started is not None:
+        metrics.HTTP_LATENCY.observe(time.perf_counter() - started, route=request.endpoint or 'unmatched',
+                                     status=response.status_code)
+    return response
+
 @app.route("/")
 def index():
     host = request.host
@@ -172,7 +510,9 @@ def channels(provider, country_code):
     # host = request.host
     channels, error = providers[provider].channels(country_code)
     if error: return f"ERROR: {error}", 400
-    return(channels)
+    # The merged lineup is a tuple, Flask would read that as (body, status)
+    return(list(channels))
+
 
 @app.get("/<provider>/<country_code>/epg.json")
 def epg_json(provider, country_code):
@@ -189,42 +529,27 @@ def stitch_json(provider, country_code):
 @app.get("/<provider>/<country_code>/playlist.m3u")
 def playlist(provider, country_code):
     if country_code.lower() == 'all':
-        stations, err = providers[provider].channels_all()
-    elif country_code.lower() in ALLOWED_COUNTRY_CODES:
-        stations, err = providers[provider].channels(country_code)
-    else: # country_code not in ALLOWED_COUNTRY_CODES
+        country_code = 'all'
+    elif country_code.lower() not in ALLOWED_COUNTRY_CODES:
         return "Invalid county code", 400
 
     host = request.host
     channel_id_format = request.args.get('channel_id_format','').lower()
-    
+
+    rendered, err = playlists[provider].get(country_code, channel_id_format, host)
     if err is not None:
         return err, 500
-    stations = sorted(stations, key = lambda i: i.get('number', 0))
+    body, etag = rendered
 
-    m3u = "#EXTM3U\r\n\r\n"
-    for s in stations:
-        url = f"http://{host}/{provider}/{country_code}/watch/{s.get('watchId') or s.get('id')}\n\n"
-
-        if channel_id_format == 'id':
-            m3u += f"#EXTINF:-1 channel-id=\"{provider}-{s.get('id')}\""
-        elif channel_id_format == 'slug_only':
-            m3u += f"#EXTINF:-1 channel-id=\"{s.get('slug')}\""
-        else:
-            m3u += f"#EXTINF:-1 channel-id=\"{provider}-{s.get('slug')}\""
-        m3u += f" tvg-id=\"{s.get('id')}\""
-        m3u += f" tvg-chno=\"{''.join(map(str, str(s.get('number', []))))}\"" if s.get('number') else ""
-        m3u += f" group-title=\"{''.join(map(str, s.get('group', [])))}\"" if s.get('group') else ""
-        m3u += f" tvg-logo=\"{''.join(map(str, s.get('logo', [])))}\"" if s.get('logo') else ""
-        m3u += f" tvg-name=\"{''.join(map(str, s.get('tmsid', [])))}\"" if s.get('tmsid') else ""
-        m3u += f" tvc-guide-title=\"{''.join(map(str, s.get('name', [])))}\"" if s.get('name') else ""
-        m3u += f" tvc-guide-description=\"{remove_non_printable(''.join(map(str, s.get('summary', []))))}\"" if s.get('summary') else ""
-        m3u += f" tvg-shift=\"{''.join(map(str, s.get('timeShift', [])))}\"" if s.get('timeShift') else ""
-        m3u += f",{s.get('name') or s.get('call_sign')}\n"
-        m3u += f"{url}\n"
-
-    response = Response(m3u, content_type='audio/x-mpegurl')
-    return (response)
+    # Stream the large lineups instead of handing over one big buffer
+    if len(body) > PlaylistCache.CHUNK_SIZE:
+        chunks = (body[i:i + PlaylistCache.CHUNK_SIZE] for i in range(0, len(body), PlaylistCache.CHUNK_SIZE))
+        response = Response(chunks, content_type='audio/x-mpegurl')
+        response.content_length = len(body)
+    else:
+        response = Response(body, content_type='audio/x-mpegurl')
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.get("/mjh_compatible/<provider>/<country_code>/playlist.m3u")
 def playlist_mjh_compatible(provider, country_code):
@@ -238,60 +563,72 @@ def playlist_maddox_compatible(provider, country_code):
 
 @app.route("/<provider>/<country_code>/watch/<id>")
 def watch(provider, country_code, id):
-    client_id = providers[provider].load_device()
+    started = time.perf_counter()
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
     sid = uuid.uuid4()
-    stitcher = "https://cfd-v4-service-channel-stitcher-use1-1.prd.pluto.tv"
-    base_path = f"/stitch/hls/channel/{id}/master.m3u8"
-
-    jwt_required_list = ['625f054c5dfea70007244612', '625f04253e5f6c000708f3b7', '5421f71da6af422839419cb3']
-    
-    params = {'advertisingId': '',
-              'appName': 'web',
-              'appVersion': 'unknown',
-              'appStoreUrl': '',
-              'architecture': '',
-              'buildVersion': '',
-              'clientTime': '0',
-              'deviceDNT': '0',
-              'deviceId': client_id,
-              'deviceMake': 'Chrome',
-              'deviceModel': 'web',
-              'deviceType': 'web',
-              'deviceVersion': 'unknown',
-              'includeExtendedEvents': 'false',
-              'sid': sid,
-              'userId': '',
-              'serverSideAds': 'true'
-    }
 
-    if id in jwt_required_list:
+    if id in JWT_REQUIRED_CHANNELS:
         resp, error= providers[provider].resp_data(country_code)
         if error: return error, 500
         # print(json.dumps(resp, indent=2))
         token = resp.get('sessionToken','')
         stitcherParams = resp.get("stitcherParams",'')
-        video_url = f'{stitcher}/v2{base_path}?{stitcherParams}&jwt={token}&masterJWTPassthrough=true&includeExtendedEvents=true'
+        video_url = f'{STITCHER}/v2/stitch/hls/channel/{id}/master.m3u8?{stitcherParams}&jwt={token}&masterJWTPassthrough=true&includeExtendedEvents=true'
     else:
-        parsed_url = urlparse(f"{stitcher}{base_path}")
-        base_query_params = parse_qs(parsed_url.query)
-        # Update base query parameters with the provided parameters
-        for key, value in params.items():
-            if key in base_query_params:
-                # Extend the existing values with new values if the parameter already exists
-                base_query_params[key].extend(value)
-            else:
-                # Add new parameter and its values
-                base_query_params[key] = value
+        # Only the session id changes between tunes of the same channel
+        template = stitcher_templates.get(id)
+        if template is None:
+            if len(stitcher_templates) >= 4096:
+                stitcher_templates.clear()
+            template = stitcher_template(id, providers[provider].load_device())
+            stitcher_templates[id] = template
+        video_url = f"{template[0]}{sid}{template[1]}"
+
+    response = None
+    if stitcher_proxy:
+        body, error = master_playlists[provider].get(country_code, id, video_url)
+        if error:
+            # Fall back to the redirect, the player can still try the stitcher itself
+            print(f"[ERROR] Stitcher proxy for {id}: {error}")
+        else:
+            response = Response(body, content_type='application/vnd.apple.mpegurl')
+            response.headers['Cache-Control'] = 'no-store'
+
+    if access_log:
+        print(json.dumps({'event': 'watch', 'provider': provider, 'country_code': country_code, 'id': id,
+                          'jwt': id in JWT_REQUIRED_CHANNELS, 'proxied': response is not None,
+                          'ms': round((time.perf_counter() - started) * 1000, 3)}))
+    return response if response is not None else (redirect(video_url))
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    session_stats(providers[provider].session)
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-        # Construct updated query string
-        updated_query = urlencode(base_query_params, doseq=True)
 
-        # Generate the final URL
-        video_url = urlunparse((parsed_url.scheme, parsed_url.netloc, parsed_url.path,
-                               parsed_url.params, updated_query, parsed_url.fragment))
+@app.get("/scheduler/status")
+def scheduler_status():
+    return scheduler.status()
 
-    print(video_url)
-    return (redirect(video_url))
+@app.post("/scheduler/run/<name>")
+def scheduler_run(name):
+    if not admin_token:
+        return "Set PLUTO_ADMIN_TOKEN to enable on-demand refresh", 403
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ') or request.args.get('token', '')
+    if not hmac.compare_digest(supplied.encode(), admin_token.encode()):
+        return "Unauthorized", 401
+
+    # "epg" refreshes every country, epg-all follows once they are done
+    names = [job for job in scheduler.jobs if job.startswith('epg-') and job != 'epg-all'] if name == 'epg' else [name]
+    if not all(scheduler.trigger(job) for job in names):
+        return f"Unknown job {name}", 404
+    return {'triggered': names}, 202
+
+@app.get("/<provider>/epg/generation")
+def epg_generation(provider):
+    return providers[provider].epg_generation
 
 @app.get("/<provider>/epg/<country_code>/<filename>")
 def epg_xml(provider, country_code, filename):
@@ -315,11 +652,28 @@ def epg_xml(provider, country_code, filename):
         # Specify the file path based on the provider and filename
         file_path = f'{filename}'
 
-        # Return the file without explicitly opening it
+        # Return the file without explicitly opening it. send_file answers
+        # If-None-Match / If-Modified-Since with a 304 from the ETag and
+        # Last-Modified it derives from the file.
         if filename in ALLOWED_EPG_FILENAMES: 
-            return send_file(file_path, as_attachment=False, download_name=file_path, mimetype='text/plain')
+            compressed_file_path = f'{file_path}.gz'
+            # Clients that accept gzip get the precompressed copy of the same guide
+            if request.accept_encodings.quality('gzip') > 0 and os.path.exists(compressed_file_path):
+                response = send_file(compressed_file_path, as_attachment=False, download_name=file_path, mimetype='text/plain',
+                                     conditional=True, etag=True)
+                response.content_encoding = 'gzip'
+            else:
+                response = send_file(file_path, as_attachment=False, download_name=file_path, mimetype='text/plain',
+                                     conditional=True, etag=True)
+            response.vary.add('Accept-Encoding')
         elif filename in ALLOWED_GZ_FILENAMES:
-            return send_file(file_path, as_attachment=True, download_name=file_path)
+            response = send_file(file_path, as_attachment=True, download_name=file_path, conditional=True, etag=True)
+
+        # Lets clients tell when a new guide has been published
+        generation = providers[provider].epg_generation.get(filename.removesuffix('.gz'), {}).get('generation')
+        if generation is not None:
+            response.headers['X-EPG-Generation'] = str(generation)
+        return response
 
     except FileNotFoundError:
         # Handle the case where the file is not found
@@ -333,53 +687,54 @@ def epg_xml(provider, country_code, filename):
         # Handle other unexpected errors
         return f"An error occurred: {str(e)}", 500
 
-# Define the function you want to execute every four hours
-def epg_scheduler():
-    print("[INFO] Running EPG Scheduler")
-    if all(item in ALLOWED_COUNTRY_CODES for item in pluto_country_list):
-        for code in pluto_country_list:
-            error = providers[provider].create_xml_file(code)
-            if error: print(f"{error}")
-        error = providers[provider].create_xml_file(pluto_country_list)
-        if error: print(f"{error}")
-    print("[INFO] EPG Scheduler Complete")
-
-# Schedule the function to run every two hours
-schedule.every(2).hours.do(epg_scheduler)
-
-# Define a function to run the scheduler in a separate thread
-def scheduler_thread():
-    # Run the task immediately when the thread starts
+# Countries with a scheduled EPG job, and those refreshed since epg-all was last built
+scheduled_countries = set()
+refreshed_countries = set()
+
+# One EPG job per country, staggered so the upstream requests do not all land at once
+def country_job(country_code):
+    def run():
+        error = providers[provider].refresh_country(country_code)
+        if error: return [error]
+        playlists[provider].refresh(country_code, fetch=False)
+        # epg-all is published once per cycle, after the last country has caught up,
+        # so DVRs see one new generation rather than one per country
+        refreshed_countries.add(country_code)
+        if refreshed_countries >= scheduled_countries:
+            scheduler.trigger('epg-all')
+    return run
+
+def all_job():
+    # Also runs on its own interval in case a country keeps failing, there is
+    # nothing to publish when no country has refreshed since the last build
+    if not refreshed_countries:
+        return None
+    refreshed_countries.clear()
+    errors = providers[provider].refresh_all_file(pluto_country_list)
+    playlists[provider].refresh('all', fetch=False)
+    return errors
+
+scheduler = Scheduler()
+for i, code in enumerate(pluto_country_list):
+    if code == 'all':
+        continue
+    if code not in ALLOWED_COUNTRY_CODES:
+        print(f"[ERROR] Unknown country code {code}, not scheduling its EPG")
+        continue
+    scheduled_countries.add(code)
+    scheduler.add(f"epg-{code}", country_job(code), epg_interval, delay=i * epg_stagger, jitter=epg_interval * 0.05)
+# Normally triggered by the last country job, the longer interval only fires when one has failed
+scheduler.add('epg-all', all_job, epg_interval * 1.5, delay=epg_interval * 1.5)
+# Keep every country's boot token renewed ahead of its expiry
+scheduler.add('tokens', lambda: providers[provider].refresh_tokens(pluto_country_list), 60)
+
+def main():
     try:
-        epg_scheduler()
-    except Exception as e:
-        print(f"Error running initial task: {e}")
+        # Serve cached lineups right away, the scheduler refreshes them in the background
+        providers[provider].warm_start(pluto_country_list)
+        playlists[provider].rebuild()
 
-    # Continue as Scheduled
-    while True:
-        try:
-            schedule.run_pending()
-            time.sleep(1)
-        except Exception as e:
-             print(f"[ERROR] Error in scheduler thread: {e}")
-
-# Function to monitor and restart the thread if needed
-def monitor_thread(thread_func):
-    thread = Thread(target=thread_func, daemon=True)
-    print("[INFO] Initializing Scheduler")
-    thread.start()
-
-    while True:
-        if not thread.is_alive():
-            print("[ERROR] Scheduler Thread Stopped. Restarting...")
-            thread.start()
-        time.sleep(15 * 60)  # Check every 15 minutes
-        print("[INFO] Checking Scheduler Thread")
-
-if __name__ == '__main__':
-    try:
-        # Start a monitoring thread
-        Thread(target=monitor_thread, args=(scheduler_thread,), daemon=True).start()
+        scheduler.start()
 
         print(f"⇨ http server started on [::]:{port}")
         WSGIServer(('', port), app, log=None).serve_forever()
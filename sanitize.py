@@ -0,0 +1,45 @@
+import unicodedata
+from functools import lru_cache
+
+# Text from the Pluto API is cleaned once when it is ingested, so rendering
+# the guide and serving playlists never scan it again. Almost every string is
+# already clean and is returned untouched after one isprintable() check.
+
+# Control characters XML 1.0 does not allow, tab, newline and carriage return are kept
+ILLEGAL_XML = dict.fromkeys([*range(0x00, 0x09), 0x0b, 0x0c, *range(0x0e, 0x20)])
+
+
+class NonPrintable(dict):
+    # str.translate table dropping every Unicode category C character
+    # (control, format, surrogate, private use, unassigned). Code points are
+    # looked up in unicodedata the first time they are seen and remembered.
+    def __missing__(self, codepoint):
+        value = None if unicodedata.category(chr(codepoint)).startswith('C') else codepoint
+        self[codepoint] = value
+        return value
+
+
+NON_PRINTABLE = NonPrintable()
+
+
+def xml_text(value):
+    # Drop the characters that would make the XMLTV file invalid
+    if not value or value.isprintable():
+        return value
+    return value.translate(ILLEGAL_XML)
+
+
+def printable(value):
+    # Drop control and format characters, for M3U attributes
+    if not value or value.isprintable():
+        return value
+    return value.translate(NON_PRINTABLE)
+
+
+# Descriptions repeat for every airing of an episode in every country
+@lru_cache(maxsize=65536)
+def description(value):
+    # Pluto escapes quotes in descriptions, ElementTree escapes them again on write
+    if not value:
+        return value
+    return xml_text(value).replace('&quot;', '"')
@@ -0,0 +1,109 @@
+import math, random, time
+import gevent
+from gevent.event import Event
+import metrics
+
+SCHEDULER_RUNS = metrics.Histogram('pluto_scheduler_run_seconds', 'Duration of scheduled jobs by result.',
+                                   ('job', 'result'))
+
+
+class Job:
+    # A job runs every interval seconds (plus or minus jitter) starting after
+    # delay. A run fails when it raises or returns errors; failures are retried
+    # after retry seconds, doubling each time up to the normal interval.
+    def __init__(self, name, func, interval, delay=0, jitter=0, retry=60):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self.next_run = time.time() + delay
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.failures = 0
+        self.running = False
+        # Set when the job is triggered mid-run, the data it ran on is already outdated
+        self.pending = None
+        self.wake = Event()
+
+    def delay_after_run(self):
+        if self.failures:
+            return min(self.retry * 2 ** (self.failures - 1), self.interval)
+        return self.interval + random.uniform(-self.jitter, self.jitter)
+
+    def status(self):
+        return {'last_run': self.last_run,
+                'last_duration': self.last_duration,
+                'last_error': self.last_error,
+                'next_run': self.next_run,
+                'failures': self.failures,
+                'running': self.running}
+
+
+class Scheduler:
+    # Each job waits in its own greenlet, so a slow or failing job never holds
+    # up the others.
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, name, func, interval, delay=0, jitter=0, retry=60):
+        job = Job(name, func, interval, delay, jitter, retry)
+        self.jobs[name] = job
+        return job
+
+    def start(self):
+        for job in self.jobs.values():
+            gevent.spawn(self.loop, job)
+
+    def trigger(self, name, delay=0):
+        # Bring the next run forward. Several triggers before the run starts
+        # are folded into one run.
+        job = self.jobs.get(name)
+        if job is None:
+            return False
+        if job.running:
+            job.pending = min(job.pending or math.inf, time.time() + delay)
+        else:
+            job.next_run = min(job.next_run, time.time() + delay)
+            job.wake.set()
+        return True
+
+    def status(self):
+        return {name: job.status() for name, job in self.jobs.items()}
+
+    def loop(self, job):
+        while True:
+            job.wake.clear()
+            wait = job.next_run - time.time()
+            if wait > 0:
+                job.wake.wait(wait)
+                continue
+            self.run(job)
+
+    def run(self, job):
+        job.running = True
+        started = time.time()
+        error = None
+        try:
+            errors = job.func()
+            if errors:
+                error = '; '.join(map(str, errors)) if isinstance(errors, list) else str(errors)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            job.running = False
+
+        job.last_run = started
+        job.last_duration = round(time.time() - started, 3)
+        job.last_error = error
+        job.failures = job.failures + 1 if error else 0
+        job.next_run = time.time() + job.delay_after_run()
+        if job.pending is not None:
+            job.next_run = min(job.next_run, job.pending)
+            job.pending = None
+
+        SCHEDULER_RUNS.observe(job.last_duration, job=job.name, result='error' if error else 'ok')
+        if error:
+            print(f"[ERROR] Job {job.name} failed ({job.failures} in a row), retrying in "
+                  f"{round(job.next_run - time.time())}s: {error}")
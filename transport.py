@@ -0,0 +1,80 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+UPSTREAM_RETRIES = metrics.Counter('pluto_upstream_retries_total', 'Upstream requests retried by host and reason.',
+                                   ('host', 'reason'))
+UPSTREAM_POOL_REQUESTS = metrics.Gauge('pluto_upstream_pool_requests', 'Requests sent through each upstream connection pool.',
+                                       ('host',))
+UPSTREAM_POOL_CONNECTIONS = metrics.Gauge('pluto_upstream_pool_connections', 'Connections opened by each upstream connection pool.',
+                                          ('host',))
+
+
+class UpstreamRetry(Retry):
+    # Retries are counted for /metrics and a Retry-After is honoured up to
+    # max_retry_after seconds, so one slow-down response cannot stall a refresh
+    RETRY_AFTER_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+    max_retry_after = 60
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        host = _pool.host if _pool is not None else ''
+        reason = response.status if response is not None else type(error).__name__
+        UPSTREAM_RETRIES.inc(host=host, reason=reason)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.max_retry_after)
+
+
+class TransportAdapter(HTTPAdapter):
+    # requests has no session-wide timeout, the adapter fills one in
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+    def stats(self):
+        # num_requests against num_connections shows how well keep-alive is reused
+        stats = {}
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            entry = stats.setdefault(pool.host, {'requests': 0, 'connections': 0})
+            entry['requests'] += pool.num_requests
+            entry['connections'] += pool.num_connections
+        for entry in stats.values():
+            entry['reused'] = max(entry['requests'] - entry['connections'], 0)
+        return stats
+
+
+def build_session(pool_size=10, connect_timeout=5, read_timeout=30, retries=3, backoff=0.5):
+    retry = UpstreamRetry(total=retries, connect=retries, read=retries, status=retries,
+                          status_forcelist=UpstreamRetry.RETRY_AFTER_STATUS_CODES,
+                          allowed_methods=frozenset(['GET']), backoff_factor=backoff, raise_on_status=False)
+    adapter = TransportAdapter((connect_timeout, read_timeout), pool_connections=4, pool_maxsize=pool_size,
+                               max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session_stats(session):
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        if isinstance(adapter, TransportAdapter):
+            stats.update(adapter.stats())
+    for host, entry in stats.items():
+        UPSTREAM_POOL_REQUESTS.set(entry['requests'], host=host)
+        UPSTREAM_POOL_CONNECTIONS.set(entry['connections'], host=host)
+    return stats
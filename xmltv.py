@@ -0,0 +1,230 @@
+import gzip, io, os, re, time
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+
+XML_DECLARATION = '<?xml version=\'1.0\' encoding=\'utf-8\'?>'
+DOCTYPE = '<!DOCTYPE tv SYSTEM "xmltv.dtd">'
+
+PLUTO_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+# Pluto timestamps are always UTC, e.g. 2024-05-01T13:30:00.000Z
+PLUTO_TIME_PATTERN = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{1,6}Z')
+
+
+# Start/stop values repeat heavily across channels, so conversions are cached.
+# Anything that does not match the fixed layout goes through strptime as before.
+@lru_cache(maxsize=65536)
+def xmltv_time(value):
+    # 2024-05-01T13:30:00.000Z -> 20240501133000 +0000
+    if PLUTO_TIME_PATTERN.fullmatch(value):
+        return f"{value[0:4]}{value[5:7]}{value[8:10]}{value[11:13]}{value[14:16]}{value[17:19]} +0000"
+    return datetime.strptime(value, PLUTO_TIME_FORMAT).replace(tzinfo=timezone.utc).strftime("%Y%m%d%H%M%S %z")
+
+
+@lru_cache(maxsize=65536)
+def xmltv_air_date(value):
+    # 2024-05-01T13:30:00.5Z -> 2024-05-01T13:30:00.500Z
+    if PLUTO_TIME_PATTERN.fullmatch(value):
+        return f"{value[:20]}{value[20:-1].ljust(3, '0')[:3]}Z"
+    return datetime.strptime(value, PLUTO_TIME_FORMAT).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+
+
+@lru_cache(maxsize=65536)
+def xmltv_date(value):
+    # 2024-05-01T13:30:00.000Z -> 20240501
+    if PLUTO_TIME_PATTERN.fullmatch(value):
+        return f"{value[0:4]}{value[5:7]}{value[8:10]}"
+    return datetime.strptime(value, PLUTO_TIME_FORMAT).strftime("%Y%m%d")
+
+
+def gzip_member(data, level, filename='', mtime=None):
+    out = io.BytesIO()
+    with gzip.GzipFile(filename=filename, mode='wb', fileobj=out, compresslevel=level, mtime=mtime) as member:
+        member.write(data)
+    return out.getvalue()
+
+
+class ParallelGzipFile:
+    # Write-only gzip file that cuts the stream into block_size blocks and
+    # compresses each into its own gzip member on a thread pool, zlib releases
+    # the GIL while it works. Concatenated members are one valid gzip stream
+    # (RFC 1952), gunzip and Python's gzip read them back as a single file.
+    #
+    # Members are written in order and at most two per thread are in flight,
+    # so memory stays bounded whatever the size of the file.
+    def __init__(self, fileobj, filename='', level=9, threads=2, block_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.filename = filename
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.mtime = int(time.time())
+        self.executor = ThreadPoolExecutor(threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._members = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def close(self):
+        if self.executor is None:
+            return
+        try:
+            # An empty file still gets one (empty) member
+            if self._buffered or not self._members:
+                self._submit()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def _submit(self):
+        # Only the first member carries the file name, like gzip -c a b > c
+        filename = '' if self._members else self.filename
+        block = b''.join(self._buffer)
+        self._pending.append(self.executor.submit(gzip_member, block, self.level, filename, self.mtime))
+        self._members += 1
+        self._buffer = []
+        self._buffered = 0
+        while len(self._pending) > self.threads * 2:
+            self.fileobj.write(self._pending.popleft().result())
+
+
+class XMLTVWriter:
+    # Streams an XMLTV document one <channel>/<programme> element at a time,
+    # writing the plain .xml and the .xml.gz in the same pass.
+    #
+    # Both files are written under a versioned name in staging_dir and only
+    # renamed over the published paths once the document is complete, so
+    # readers always see either the previous or the new guide in full.
+    #
+    # With gzip_threads above 1 the .xml.gz is a multi-member file compressed
+    # in parallel, otherwise a single member streamed on this thread.
+    def __init__(self, xml_file_path, compressed_file_path, attrib=None, buffer_size=64 * 1024,
+                 staging_dir='.staging', version=None, gzip_level=9, gzip_threads=1):
+        self.xml_file_path = xml_file_path
+        self.compressed_file_path = compressed_file_path
+        self.attrib = attrib or {}
+        self.buffer_size = buffer_size
+        self.staging_dir = staging_dir
+        self.version = version if version is not None else os.getpid()
+        self.gzip_level = gzip_level
+        self.gzip_threads = gzip_threads
+        self.element_count = 0
+        # Seconds spent serialising elements, compressing and writing the plain file
+        self.timings = {'serialize': 0.0, 'gzip': 0.0, 'write': 0.0}
+        self._buffer = []
+        self._buffered = 0
+        self._xml_file = None
+        self._raw_gz_file = None
+        self._gz_file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(finish=exc_type is None)
+        return False
+
+    def staging_path(self, path):
+        staging_dir = os.path.join(os.path.dirname(path), self.staging_dir)
+        return os.path.join(staging_dir, f"{os.path.basename(path)}.{self.version}")
+
+    def open(self):
+        self._xml_staging_path = self.staging_path(self.xml_file_path)
+        self._gz_staging_path = self.staging_path(self.compressed_file_path)
+        os.makedirs(os.path.dirname(self._xml_staging_path), exist_ok=True)
+
+        self._xml_file = open(self._xml_staging_path, 'wb')
+        self._raw_gz_file = open(self._gz_staging_path, 'wb')
+        # Keep the published file name in the gzip header rather than the staging one
+        filename = os.path.basename(self.xml_file_path)
+        if self.gzip_threads > 1:
+            self._gz_file = ParallelGzipFile(self._raw_gz_file, filename, self.gzip_level, self.gzip_threads)
+        else:
+            self._gz_file = gzip.GzipFile(filename=filename, mode='wb', fileobj=self._raw_gz_file,
+                                          compresslevel=self.gzip_level)
+        root = ET.Element("tv", attrib=self.attrib)
+        # Serialise an empty root and reopen it so the closing tag can be written last
+        open_tag = ET.tostring(root, encoding='unicode')[:-len(' />')] + '>'
+        self._write(f"{XML_DECLARATION}\n{DOCTYPE}\n{open_tag}")
+
+    def write(self, elem):
+        self.write_fragment(self.serialize(elem))
+
+    def serialize(self, elem):
+        # Matches the layout ET.indent(tree, '  ') gives a child of the root element
+        started = time.perf_counter()
+        ET.indent(elem, '  ', level=1)
+        text = '\n  ' + ET.tostring(elem, encoding='unicode')
+        self.timings['serialize'] += time.perf_counter() - started
+        return text
+
+    def write_fragment(self, text):
+        # text is one element as serialize() returned it, possibly from an earlier file
+        self._write(text)
+        self.element_count += 1
+
+    def close(self, finish=True):
+        if self._xml_file is None:
+            return
+        try:
+            if finish:
+                self._write('\n</tv>')
+                self._flush()
+        except BaseException:
+            finish = False
+            raise
+        finally:
+            self._xml_file.close()
+            started = time.perf_counter()
+            self._gz_file.close()
+            self.timings['gzip'] += time.perf_counter() - started
+            self._raw_gz_file.close()
+            self._xml_file = None
+            self._gz_file = None
+            self._raw_gz_file = None
+            if finish:
+                self.publish()
+            else:
+                self.discard()
+
+    def publish(self):
+        # os.replace is atomic, requests already streaming the old file keep reading it
+        os.replace(self._gz_staging_path, self.compressed_file_path)
+        os.replace(self._xml_staging_path, self.xml_file_path)
+
+    def discard(self):
+        for path in (self._xml_staging_path, self._gz_staging_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        started = time.perf_counter()
+        data = ''.join(self._buffer).encode('utf-8')
+        self._xml_file.write(data)
+        written = time.perf_counter()
+        self._gz_file.write(data)
+        self.timings['write'] += written - started
+        self.timings['gzip'] += time.perf_counter() - written
+
+        self._buffer = []
+        self._buffered = 0